@@ -0,0 +1,254 @@
+"""end to end benchmarks: generates a people.csv of the given sizes and times the csv mapping, the publisher's
+serialization, the consumer, the construct processor, /query under concurrent clients and the memory each store
+needs per triple. the results are printed as json, --output writes them to a file and --compare prints the change
+against an earlier file.
+
+    python bench.py --rows 1000 10000 --output before.json
+    python bench.py --rows 1000 10000 --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import rdflib as r
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from ldnode import LdNode
+from pubsub import Target
+from rdfops import load_class
+
+first_names = ['tim', 'mark', 'tom', 'bill', 'ben', 'anna', 'mary', 'sue', 'jo', 'sam']
+last_names = ['tall', 'jones', 'nixon', 'smith', 'brown', 'green', 'white', 'black']
+
+config_template = '''@prefix c: <http://node/config/> .
+@prefix p: <https://person/> .
+
+<https://bench.people> c:store-class "{store_class}" ;
+    c:http_port {port} ;
+.
+
+c:people-publisher a c:Processor;
+    c:class-name "pubsub.Publisher";
+    c:file '{csv_file}';
+    c:subject-template '{{{{first}}}}' ;
+    c:uri-stub 'https://person/' ;
+    c:type 'https://person/Person' ;
+    c:guess-types true ;
+    c:stream true ;
+.
+
+c:load-people a c:Processor;
+    c:class-name "pubsub.Consumer";
+    c:target 'http://localhost:{port}/publisher/people-publisher' ;
+.
+
+c:construct-fullname c:class-name "processors.ConstructProcessor" ;
+   a c:Processor ;
+   c:sparql \'\'\'CONSTRUCT {{?s <https://person/fullname> ?fullname}}
+                WHERE
+                {{
+                    ?s <https://person/first> ?first;
+                        <https://person/last> ?last;
+                        BIND(CONCAT(?first, " ",  ?last) AS ?fullname)
+                }} \'\'\' ;
+   c:incremental true ;
+.
+
+p:people a c:Query;
+    c:sparql \'\'\'
+    SELECT DISTINCT ?name ?age
+    WHERE {{
+        ?s <https://person/fullname> ?name .
+        ?s <https://person/age> ?age .
+        {{{{#if min-age}}}}
+        FILTER(?age >= {{{{min-age}}}} )
+        {{{{/if}}}}
+        }} \'\'\';
+.
+'''
+
+
+class CountingTarget(Target):
+    """throws the triples away, so only the mapping is timed"""
+    def __init__(self):
+        self.count = 0
+
+    def store(self, triples):
+        for _ in triples:
+            self.count += 1
+
+
+def generate_people(file_name, rows, seed=1):
+    """a people.csv with rows people, the first names are made unique as they are the subject"""
+    rnd = random.Random(seed)
+    with open(file_name, 'w') as f:
+        f.write('first,last,age,spouse,date,\n')
+        for i in range(rows):
+            spouse = rnd.choice(first_names) + str(rnd.randrange(rows)) if rnd.random() < 0.3 else ''
+            date = f'{rnd.randint(1, 28):02}-{rnd.randint(1, 12):02}-{rnd.randint(1950, 2020)}'
+            f.write(f'{rnd.choice(first_names)}{i},{rnd.choice(last_names)},{rnd.randint(1, 99)},{spouse},{date}\n')
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def bench_queries(port, clients, requests_per_client, seed=1):
+    rnd = random.Random(seed)
+    urls = [f'http://localhost:{port}/query/people?content-type=csv&min-age={rnd.randint(1, 99)}'
+            for _ in range(clients * requests_per_client)]
+
+    def get(url):
+        start = time.perf_counter()
+        with urllib.request.urlopen(url) as rsp:
+            rsp.read()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        took = list(pool.map(get, urls))
+    total = time.perf_counter() - start
+    return {'clients': clients, 'requests': len(took), 'requests_per_s': len(took) / total,
+            'p50_ms': percentile(took, 0.5) * 1000, 'p99_ms': percentile(took, 0.99) * 1000}
+
+
+def bench_memory(store_class, data_file):
+    tracemalloc.start()
+    store = load_class(store_class)('https://person/')
+    store.parse(source=data_file, format='turtle')
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {'triples': len(store.g), 'bytes_per_triple': size / max(1, len(store.g))}
+
+
+def bench(rows, work_dir, store_class, port, clients, requests_per_client, memory_stores):
+    csv_file = os.path.join(work_dir, f'people-{rows}.csv')
+    took, _ = timed(generate_people, csv_file, rows)
+    result = {'rows': rows, 'generate_s': took}
+    config_file = os.path.join(work_dir, f'config-{rows}.ttl')
+    with open(config_file, 'w') as f:
+        f.write(config_template.format(store_class=store_class, port=port, csv_file=csv_file))
+    node = LdNode(config=config_file, uri='https://bench.people', uri_stub='https://person/')
+    publisher = node.processors[r.URIRef('http://node/config/people-publisher')]
+    consumer = node.processors[r.URIRef('http://node/config/load-people')]
+    construct = node.processors[r.URIRef('http://node/config/construct-fullname')]
+
+    counter = CountingTarget()
+    took, _ = timed(publisher.reader.read, publisher.parser.with_writer(counter))
+    result['ingest'] = {'triples': counter.count, 'seconds': took, 'rows_per_s': rows / took,
+                        'triples_per_s': counter.count / took}
+
+    # the file target maps the csv again, the difference is the serialization
+    took, _ = timed(publisher.reader.read, publisher.parser)
+    result['serialize'] = {'seconds': took, 'serialize_s': max(0.0, took - result['ingest']['seconds'])}
+
+    node.start()
+    try:
+        time.sleep(1)
+        took, _ = timed(lambda: consumer.run().result())
+        result['consume'] = {'seconds': took, 'triples': len(node.store.g)}
+        took, _ = timed(construct.run)
+        result['construct'] = {'full_s': took, 'triples': len(node.store.g)}
+        added = max(1, rows // 100)
+        node.store.add_many(triple for i in range(added) for triple in (
+            (r.URIRef(f'https://person/new{i}'), r.URIRef('https://person/first'), r.Literal(f'new{i}')),
+            (r.URIRef(f'https://person/new{i}'), r.URIRef('https://person/last'), r.Literal('person'))))
+        took, _ = timed(construct.run)
+        result['construct']['incremental_s'] = took
+        result['construct']['incremental_rows'] = added
+        result['query'] = bench_queries(port, clients, requests_per_client)
+    finally:
+        node.stop()
+
+    result['memory'] = {name: bench_memory(name, publisher.source.file_name) for name in memory_stores}
+    return result
+
+
+def compare(results, baseline):
+    """the ratio new / old of every number that is in both runs, keyed by rows and path"""
+    def flatten(value, path, out):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                flatten(v, path + (k,), out)
+        elif isinstance(value, (int, float)):
+            out['.'.join(path)] = value
+        return out
+
+    old = {run['rows']: flatten(run, (), {}) for run in baseline['runs']}
+    for run in results['runs']:
+        if run['rows'] not in old:
+            continue
+        for key, value in flatten(run, (), {}).items():
+            before = old[run['rows']].get(key)
+            if before and key != 'rows':
+                print(f'{run["rows"]:>10} {key:<40} {before:>14.4f} -> {value:>14.4f} {value / before:>7.2f}x')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ldnode benchmarks')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--store-class', default='store.InMemoryStore')
+    parser.add_argument('--memory-stores', nargs='+', default=['store.InMemoryStore', 'store.CompactStore'])
+    parser.add_argument('--port', type=int, default=8898)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=25, help='requests per client')
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--run-to', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_to is not None:
+        # a child run: one size, the web app can only be started once per process
+        work_dir = os.path.dirname(args.run_to)
+        os.chdir(work_dir)  # the publisher writes its data file to the working directory
+        result = bench(args.rows[0], work_dir, args.store_class, args.port, args.clients, args.requests,
+                       args.memory_stores)
+        with open(args.run_to, 'w') as f:
+            json.dump(result, f)
+        return
+
+    results = {'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+               'store_class': args.store_class, 'started': time.time(), 'runs': []}
+    work_dir = tempfile.mkdtemp(prefix='ldnode-bench-')
+    for rows in args.rows:
+        run_to = os.path.join(work_dir, f'result-{rows}.json')
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--rows', str(rows), '--store-class',
+                        args.store_class, '--memory-stores', *args.memory_stores, '--port', str(args.port),
+                        '--clients', str(args.clients), '--requests', str(args.requests), '--run-to', run_to],
+                       stdout=subprocess.DEVNULL, check=True)
+        with open(run_to) as f:
+            results['runs'].append(json.load(f))
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
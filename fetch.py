@@ -0,0 +1,179 @@
+import asyncio
+import random
+import threading
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class Response:
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers  # lower case names
+        self.body = body  # None when the body went to a sink
+        self.url = None  # where the response came from, after the redirects
+
+
+class RetryableStatus(Exception):
+    pass
+
+
+class HttpPool:
+    """an http/1.1 client on its own event loop thread: connections are kept alive and reused per host, at most
+    per_host requests run against a host at the same time, connecting and every read have a timeout (so a big
+    download is never cut off while it moves), redirects are followed and failed attempts (connection errors,
+    timeouts, 429 and 502-504) are retried with exponential backoff. the loop only moves bytes, parse_pool is there
+    to run the parsing of what was fetched"""
+    retry_statuses = (429, 502, 503, 504)
+    redirect_statuses = (301, 302, 303, 307, 308)
+    max_redirects = 5
+
+    def __init__(self, per_host=4, max_idle=4, parse_workers=2):
+        self.per_host = per_host
+        self.max_idle = max_idle
+        self.idle = {}
+        self.limits = {}
+        self.parse_pool = ThreadPoolExecutor(parse_workers, thread_name_prefix='parse')
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='fetch', daemon=True).start()
+
+    def submit(self, coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def fetch(self, url, headers=None, timeout=60.0, retries=3, backoff=0.5, sink=None) -> Future:
+        return self.submit(self.request(url, headers, timeout, retries, backoff, sink))
+
+    async def request(self, url, headers=None, timeout=60.0, retries=3, backoff=0.5, sink=None) -> Response:
+        """a GET of url, the body is written to sink (a binary file) when there is one. the response is the one
+        at the end of the redirects, response.url tells where that was"""
+        for _ in range(self.max_redirects + 1):
+            response = await self.retrying(url, headers or {}, timeout, retries, backoff, sink)
+            location = response.headers.get('location')
+            if response.status not in self.redirect_statuses or location is None:
+                response.url = url
+                return response
+            url = urllib.parse.urljoin(url, location)
+        raise Exception(f'fetching {url} failed: more than {self.max_redirects} redirects')
+
+    async def retrying(self, url, headers, timeout, retries, backoff, sink):
+        for attempt in range(retries + 1):
+            try:
+                return await self.attempt(url, headers, timeout, sink)
+            except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError, RetryableStatus) as e:
+                if attempt == retries:
+                    raise Exception(f'fetching {url} failed after {attempt + 1} attempts: {e!r}')
+                delay = backoff * 2 ** attempt * (0.5 + random.random())
+                print(f'fetching {url} failed ({e!r}), retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
+
+    async def attempt(self, url, headers, timeout, sink):
+        parts = urllib.parse.urlsplit(url)
+        secure = parts.scheme == 'https'
+        key = (parts.scheme, parts.hostname, parts.port or (443 if secure else 80))
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        if key not in self.limits:
+            self.limits[key] = asyncio.Semaphore(self.per_host)
+        async with self.limits[key]:
+            while True:
+                reader, writer, reused = await self.connect(key, secure, timeout)
+                if sink is not None:
+                    sink.seek(0)
+                    sink.truncate()
+                try:
+                    response, reusable = await self.exchange(reader, writer, parts.netloc, path, headers, sink,
+                                                             timeout)
+                except (OSError, EOFError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        continue  # the server closed the idle connection, that is not worth a retry
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if reusable and len(self.idle.setdefault(key, [])) < self.max_idle:
+                    self.idle[key].append((reader, writer))
+                else:
+                    writer.close()
+                if response.status in self.retry_statuses:
+                    raise RetryableStatus(f'{response.status} {response.reason}')
+                return response
+
+    async def connect(self, key, secure, timeout):
+        idle = self.idle.get(key, [])
+        while len(idle) > 0:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(key[1], key[2], ssl=secure or None), timeout)
+        return reader, writer, False
+
+    @staticmethod
+    async def exchange(reader, writer, host, path, headers, sink, timeout):
+        """one request and its response, timeout is for every write and read on its own"""
+        def timed(coroutine):
+            return asyncio.wait_for(coroutine, timeout)
+
+        async def read_exactly(size):
+            while size > 0:
+                block = await timed(reader.read(min(size, 1 << 16)))
+                if not block:
+                    raise EOFError(f'the connection was closed with {size} bytes of the body to come')
+                write(block)
+                size -= len(block)
+
+        lines = [f'GET {path} HTTP/1.1', f'Host: {host}', 'Connection: keep-alive']
+        lines += [f'{k}: {v}' for k, v in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await timed(writer.drain())
+        status_line = await timed(reader.readline())
+        if not status_line:
+            raise EOFError('the connection was closed before the response')
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        response_headers = {}
+        while True:
+            line = (await timed(reader.readline())).decode('latin-1').rstrip('\r\n')
+            if line == '':
+                break
+            name, value = line.split(':', 1)
+            response_headers[name.strip().lower()] = value.strip()
+        status = int(status)
+        body = []
+        write = body.append if sink is None else sink.write
+        connection = {x.strip() for x in response_headers.get('connection', '').lower().split(',')}
+        # http/1.0 closes after the response unless the server says it keeps the connection
+        reusable = 'keep-alive' in connection if version == 'HTTP/1.0' else 'close' not in connection
+        if status in (204, 304) or 100 <= status < 200:
+            pass
+        elif response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await timed(reader.readline())).split(b';')[0].strip(), 16)
+                if size == 0:
+                    while (await timed(reader.readline())) not in (b'\r\n', b'\n', b''):
+                        pass  # trailers
+                    break
+                await read_exactly(size)
+                await timed(reader.readline())
+        elif 'content-length' in response_headers:
+            await read_exactly(int(response_headers['content-length']))
+        else:
+            reusable = False
+            while True:
+                block = await timed(reader.read(1 << 16))
+                if not block:
+                    break
+                write(block)
+        return Response(status, reason, response_headers, b''.join(body) if sink is None else None), reusable
+
+
+shared_pool: HttpPool = None
+shared_pool_lock = threading.Lock()
+
+
+def get_pool(per_host=4, max_idle=4, parse_workers=2) -> HttpPool:
+    """the pool every consumer of the process shares, the first caller decides its settings"""
+    global shared_pool
+    with shared_pool_lock:
+        if shared_pool is None:
+            shared_pool = HttpPool(per_host, max_idle, parse_workers)
+        return shared_pool
@@ -0,0 +1,332 @@
+"""secondary indexes on the literal values of a predicate, configured on the node with c:range-index and
+c:text-index. a range index keeps the numbers, dates and date times of the predicate in sorted order, a text
+index its strings in sorted order (for prefixes) and by lower case trigram (for substrings).
+
+a FILTER right above a basic graph pattern is evaluated from an index when one of its && parts is a comparison
+of an indexed object variable with a value (?age >= 30, ?age < ?arg_max_age), STRSTARTS, REGEX with a ^prefix
+or CONTAINS (of the variable or its LCASE/UCASE). the index only narrows down the rows, the whole filter is still
+evaluated on every one of them, with the values of the predicate the index does not order (rdflib compares a
+string with a number, for one). queries on a snapshot (c:isolation "snapshot") and queries of the thread that is
+writing, which sees writes the indexes do not have yet, are evaluated as usual"""
+import bisect
+import heapq
+import math
+import threading
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from itertools import chain
+from typing import Dict, List
+import rdflib as r
+from rdflib.namespace import XSD
+from rdflib.plugins.sparql import CUSTOM_EVALS
+from rdflib.plugins.sparql.evaluate import evalBGP
+from rdflib.plugins.sparql.evalutils import _ebv
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.plugins.sparql.sparql import AlreadyBound
+import metrics
+from rdfops import conjuncts
+
+index_scans = metrics.counter('ldnode_index_scans_total', 'filters evaluated from a literal index',
+                              ('predicate', 'kind'))
+flipped = {'<': '>', '<=': '>=', '>': '<', '>=': '<=', '=': '='}
+regex_specials = set('\\.^$*+?()[]{}|')
+
+
+class SortedEntries:
+    """(key, subject, object) entries in key order, writes are collected and merged in on the next read"""
+    def __init__(self):
+        self.keys = []
+        self.entries = []
+        self.members = {}  # (subject, object) -> key
+        self.added = set()
+        self.removed = set()
+        self.lock = threading.Lock()
+
+    def add(self, key, subject, obj):
+        if (subject, obj) not in self.members:
+            self.members[(subject, obj)] = key
+            self.added.add((subject, obj))
+
+    def remove(self, subject, obj):
+        if self.members.pop((subject, obj), None) is not None:
+            self.removed.add((subject, obj))
+
+    def merge(self):
+        with self.lock:
+            if len(self.added) == 0 and len(self.removed) == 0:
+                return
+            kept = [x for x in zip(self.keys, self.entries) if x[1] not in self.removed]
+            new = sorted(((self.members[x], x) for x in self.added if x in self.members), key=lambda x: x[0])
+            merged = list(heapq.merge(kept, new, key=lambda x: x[0]))
+            self.keys = [x[0] for x in merged]
+            self.entries = [x[1] for x in merged]
+            self.added, self.removed = set(), set()
+
+    def span(self, low=None, high=None):
+        """the positions of the entries with low <= key <= high"""
+        self.merge()
+        start = 0 if low is None else bisect.bisect_left(self.keys, low)
+        end = len(self.keys) if high is None else bisect.bisect_right(self.keys, high)
+        return start, max(start, end)
+
+
+class RangeIndex:
+    kind = 'range'
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+        # date times with and without a time zone do not compare, they are kept apart
+        self.values = {'number': SortedEntries(), 'date': SortedEntries(), 'dateTime': SortedEntries(),
+                       'zonedDateTime': SortedEntries()}
+        self.others = set()
+
+    @staticmethod
+    def key(term):
+        """(value kind, sort key) of a literal, None for terms that are not numbers or dates"""
+        if not isinstance(term, r.Literal):
+            return None
+        value = term.value
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, (int, Decimal)) or (isinstance(value, float) and not math.isnan(value)):
+            return 'number', value
+        if isinstance(value, datetime):
+            if value.tzinfo is not None:
+                return 'zonedDateTime', value.astimezone(timezone.utc)
+            return 'dateTime', value
+        if isinstance(value, date):
+            return 'date', value
+        return None
+
+    def update(self, added, removed):
+        for s, p, o in removed:
+            if p == self.predicate:
+                key = self.key(o)
+                if key is not None:
+                    self.values[key[0]].remove(s, o)
+                else:
+                    self.others.discard((s, o))
+        for s, p, o in added:
+            if p == self.predicate:
+                key = self.key(o)
+                if key is not None:
+                    self.values[key[0]].add(key[1], s, o)
+                else:
+                    self.others.add((s, o))
+
+    def plan(self, expressions):
+        """(row count, rows) of the comparisons in expressions and the values of other kinds, None if there are
+        no comparisons to use"""
+        kind, low, high = None, None, None
+        for op, term in expressions:
+            key = self.key(term)
+            if key is None or op not in flipped or (kind is not None and key[0] != kind):
+                continue
+            kind, value = key
+            if op in ('>', '>=', '='):
+                low = value if low is None else max(low, value)
+            if op in ('<', '<=', '='):
+                high = value if high is None else min(high, value)
+        if kind is None:
+            return None
+        entries = self.values[kind]
+        start, end = (0, 0) if low is not None and high is not None and low > high else entries.span(low, high)
+        rest = [x for k, x in self.values.items() if k != kind]
+        count = end - start + len(self.others) + sum(len(x.members) for x in rest)
+        return count, lambda: list(chain(entries.entries[start:end], self.others, *(x.members for x in rest)))
+
+
+class TextIndex:
+    kind = 'text'
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+        self.strings = SortedEntries()
+        self.trigrams: Dict[str, set] = {}
+        self.others = set()
+
+    @staticmethod
+    def is_string(term):
+        return isinstance(term, r.Literal) and (term.datatype is None or term.datatype == XSD.string)
+
+    @staticmethod
+    def grams(text):
+        text = text.lower()
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def update(self, added, removed):
+        for s, p, o in removed:
+            if p == self.predicate and not self.is_string(o):
+                self.others.discard((s, o))
+            elif p == self.predicate:
+                self.strings.remove(s, o)
+                for gram in self.grams(str(o)):
+                    postings = self.trigrams.get(gram)
+                    if postings is not None:
+                        postings.discard((s, o))
+                        if len(postings) == 0:
+                            del self.trigrams[gram]
+        for s, p, o in added:
+            if p == self.predicate and not self.is_string(o):
+                self.others.add((s, o))
+            elif p == self.predicate:
+                self.strings.add(str(o), s, o)
+                for gram in self.grams(str(o)):
+                    self.trigrams.setdefault(gram, set()).add((s, o))
+
+    def plan(self, expressions):
+        best = None
+        for op, term in expressions:
+            if not isinstance(term, r.Literal):
+                continue
+            if op == 'prefix':
+                prefix = str(term)
+                start, end = self.strings.span(prefix, prefix + '\U0010ffff')
+                plan = end - start, lambda start=start, end=end: self.strings.entries[start:end]
+            elif op == 'contains' and len(str(term)) >= 3:
+                postings = [self.trigrams.get(x, set()) for x in self.grams(str(term))]
+                smallest = min(postings, key=len)
+                plan = len(smallest), lambda postings=postings, smallest=smallest: \
+                    [x for x in smallest if all(x in p for p in postings)]
+            else:
+                continue
+            if best is None or plan[0] < best[0]:
+                best = plan
+        if best is None:
+            return None
+        rows = best[1]
+        return best[0] + len(self.others), lambda: list(chain(rows(), self.others))
+
+
+index_kinds = {'range': RangeIndex, 'text': TextIndex}
+
+
+class LiteralIndexes:
+    """the indexes of a store, by predicate. they are put on the store's graph for the sparql evaluation to find"""
+    def __init__(self, store):
+        self.store = store
+        self.indexes: Dict[r.URIRef, List] = {}
+
+    def add(self, predicate, kind):
+        if kind not in index_kinds:
+            raise Exception(f'unknown index kind {kind}, use one of {tuple(index_kinds)}')
+        index = index_kinds[kind](predicate)
+        self.indexes.setdefault(predicate, []).append(index)
+        return index
+
+    def usable(self):
+        return len(self.indexes) > 0 and not self.store.lock.is_writer()
+
+
+def has_alternatives(pattern):
+    """whether the regex has a | outside of groups and character classes, which makes the ^ only one branch's"""
+    depth, in_class, escaped = 0, False, False
+    for c in pattern:
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif in_class:
+            in_class = c != ']'
+        elif c == '[':
+            in_class = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth = max(depth - 1, 0)
+        elif c == '|' and depth == 0:
+            return True
+    return False
+
+
+def prefix_of(pattern):
+    """the text every match of a regex has to start with, '' if there is none"""
+    if not pattern.startswith('^') or has_alternatives(pattern):
+        return ''
+    prefix = []
+    for i, c in enumerate(pattern[1:]):
+        if c in regex_specials:
+            if c in '?*{' and len(prefix) > 0:
+                prefix.pop()
+            elif c == '|':
+                return ''
+            break
+        prefix.append(c)
+    return ''.join(prefix)
+
+
+def conditions(expr, value_of):
+    """(variable, op, value) of an && part of a filter that an index can answer, None for other parts"""
+    name = expr.name if isinstance(expr, CompValue) else None
+    if name == 'RelationalExpression' and expr.op in flipped:
+        for variable, op, other in ((expr.expr, expr.op, expr.other), (expr.other, flipped[expr.op], expr.expr)):
+            if isinstance(variable, r.Variable) and value_of(variable) is None and value_of(other) is not None:
+                return variable, op, value_of(other)
+    elif name == 'Builtin_STRSTARTS' and isinstance(expr.arg1, r.Variable):
+        return expr.arg1, 'prefix', value_of(expr.arg2)
+    elif name == 'Builtin_REGEX' and isinstance(expr.text, r.Variable) and expr.flags is None:
+        pattern = value_of(expr.pattern)
+        prefix = prefix_of(str(pattern)) if isinstance(pattern, r.Literal) else ''
+        if len(prefix) > 0:
+            return expr.text, 'prefix', r.Literal(prefix)
+    elif name == 'Builtin_CONTAINS':
+        text = expr.arg1
+        if isinstance(text, CompValue) and text.name in ('Builtin_LCASE', 'Builtin_UCASE'):
+            text = text.arg
+        if isinstance(text, r.Variable):
+            return text, 'contains', value_of(expr.arg2)
+    return None
+
+
+def evaluate_indexed(ctx, part):
+    """the custom sparql evaluation of a filter above a basic graph pattern that can start from an index"""
+    if part.name != 'Filter' or part.p is None or part.p.name != 'BGP':
+        raise NotImplementedError()
+    indexes = getattr(ctx.graph, 'literal_indexes', None)
+    if indexes is None or not indexes.usable():
+        raise NotImplementedError()
+
+    def value_of(x):
+        if isinstance(x, r.Variable):
+            return ctx[x]
+        return x if isinstance(x, r.Literal) else None
+
+    found = {}
+    for expr in conjuncts(part.expr):
+        condition = conditions(expr, value_of)
+        if condition is not None and condition[2] is not None and value_of(condition[0]) is None:
+            found.setdefault(condition[0], []).append(condition[1:])
+    best = None
+    for pattern in part.p.triples:
+        s, p, o = pattern
+        # with a bound subject the pattern is a lookup already
+        if o not in found or not isinstance(p, r.URIRef) or not isinstance(s, r.Variable) or value_of(s) is not None:
+            continue
+        for index in indexes.indexes.get(p, ()):
+            plan = index.plan(found[o])
+            if plan is not None and (best is None or plan[0] < best[0]):
+                best = plan[0], plan[1], pattern, index
+    if best is None:
+        raise NotImplementedError()
+    index_scans.inc(predicate=best[3].predicate, kind=best[3].kind)
+    return filter_rows(ctx, part, best[1](), best[2])
+
+
+def filter_rows(ctx, part, rows, pattern):
+    s, p, o = pattern
+    # like rdflib, the patterns with the fewest unbound variables go first
+    rest = sorted((t for t in part.p.triples if t is not pattern),
+                  key=lambda t: len([n for n in t if n not in (s, o) and ctx[n] is None]))
+    for subject, obj in rows:
+        c = ctx.push()
+        try:
+            c[s] = subject
+            c[o] = obj
+        except AlreadyBound:
+            continue
+        for solution in evalBGP(c, rest):
+            if _ebv(part.expr, solution.forget(ctx, _except=part._vars) if not part.no_isolated_scope else solution):
+                yield solution
+
+
+CUSTOM_EVALS['ldnode-literal-indexes'] = evaluate_indexed
@@ -1,19 +1,56 @@
-from concurrent.futures.thread import ThreadPoolExecutor
 import pathlib
-from typing import Dict, Any
+import threading
+import time
+import weakref
+from collections import deque
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Any, Tuple, List
+import metrics
 from rdfops import *
 from store import Store, InMemoryStore
+from views import MaterializedView
 from web import *
 
 
+events_emitted = metrics.counter('ldnode_events_total', 'events emitted on the bus', ('event', 'mode'))
+events_queued = metrics.counter('ldnode_bus_calls_total', 'async listener calls by what happened to them',
+                                ('event', 'outcome'))
+queue_depth = metrics.gauge('ldnode_bus_queue_depth', 'listener calls waiting in the queue of an event', ('event',))
+listener_seconds = metrics.histogram('ldnode_listener_seconds', 'time a listener took', ('event', 'listener'))
+listener_wait = metrics.histogram('ldnode_listener_wait_seconds', 'time an async call waited in the queue', ('event',))
+listener_errors = metrics.counter('ldnode_listener_errors_total', 'listeners that raised', ('event', 'listener'))
+processor_seconds = metrics.histogram('ldnode_processor_run_seconds', 'time a processor method took',
+                                      ('processor', 'method'))
+processor_errors = metrics.counter('ldnode_processor_errors_total', 'processor runs that failed', ('processor',))
+waves_started = metrics.counter('ldnode_pipeline_waves_total', 'waves of processors started by an event', ('event',))
+store_triples = metrics.gauge('ldnode_store_triples', 'triples in the store of a node', ('node',))
+store_generation = metrics.gauge('ldnode_store_generation', 'writes committed to the store of a node', ('node',))
+# the nodes the metrics collector reads, a node leaves when it stops or is garbage collected
+metered_nodes = weakref.WeakSet()
+metered_lock = threading.Lock()
+
+
+def collect_node_metrics():
+    with metered_lock:
+        nodes = list(metered_nodes)
+    for node in nodes:
+        node.collect_metrics()
+
+
+metrics.registry.collect(collect_node_metrics)
+
+
 class LdNode:
     def __init__(self, config: 'Config' = None, uri=None, uri_stub=None, parent: 'LdNode' = None):
         self.running_async = False
-        self.bus = Bus()
         self.processors = {}
         self.config: 'Config' = config
         self.parent = parent
         self.loaded_objects: Dict[r.URIRef:, Any] = {}
+        self.registry_lock = threading.RLock()
+        self.config_snapshot: 'ConfigSnapshot' = None
 
         if config is not None:
             self.config = config if config is Config else Config(config)
@@ -23,18 +60,43 @@ class LdNode:
             self.config_instance = self.config.subject(uri)
         self.uri = uri
         self.uri_stub = uri if uri_stub is None else uri_stub
+        if config is not None:
+            self.bus = Bus(int(self.config_instance.value('bus-workers', 5)),
+                           int(self.config_instance.value('bus-queue-size', 100)),
+                           self.config_instance.value('bus-policy', 'block'))
+            self.pipeline = Pipeline(self, int(self.config_instance.value('pipeline-workers',
+                                                                          self.bus.workers)))
+        else:
+            self.bus = Bus()
+            self.pipeline = Pipeline(self)
 
-        self.store: Store = InMemoryStore(self.uri_stub)
+        if config is not None:
+            trace_file = self.config_instance.value('trace-file', None, True)
+            if trace_file is not None:
+                metrics.trace_log.open(str(trace_file))
+            with metered_lock:
+                metered_nodes.add(self)
+
+        store_class = None if config is None else self.config_instance.value('store-class', None, True)
+        self.store: Store = InMemoryStore(self.uri_stub) if store_class is None \
+            else load_class(store_class)(self.uri_stub, self.config_instance)
         if self.config is not None:
-            for t in self.config.store.filter((None, None, None)):
-                self.store.add_triple(t)
+            self.store.add_many(self.config.store.filter((None, None, None)))
 
         self.load_from_config()
 
+    def collect_metrics(self):
+        store_generation.set(self.store.generation, node=self.uri)
+        if hasattr(self.store, 'g'):
+            store_triples.set(len(self.store.g), node=self.uri)
+        for event, depth in self.bus.depths().items():
+            queue_depth.set(depth, event=event)
+
     def load_from_config(self):
         if self.config is None:
             return
         self.load_processors()
+        self.load_views()
 
     def start(self):
         self.emit('before-started')
@@ -45,6 +107,8 @@ class LdNode:
         self.emit('after-started')
 
     def stop(self):
+        with metered_lock:
+            metered_nodes.discard(self)
         stop_http_server()
         self.stop_sync_loop()
         self.emit('before-stop')
@@ -52,6 +116,7 @@ class LdNode:
 
     def stop_sync_loop(self):
         self.running_async = False
+        self.bus.stop()
 
     def start_sync_loop(self):
         if self.running_async:
@@ -59,40 +124,32 @@ class LdNode:
         self.running_async = True
 
     def get_processor_subjects(self):
-        results = self.config.filter(obj=NodeConstants.processor_type)
-        for res in results:
-            uri = res[0]
-            info = self.config.subject(uri)
-            yield info
+        for uri in self.config.snapshot().subjects_with(NodeConstants.processor_type):
+            yield self.config.subject(uri)
 
     def load_processors(self):
         # TODO: need to diff here https://rdflib.readthedocs.io/en/4.0/_modules/rdflib/compare.html
         # TODO: need to stop running processors
         # TODO: type inheritance
         self.processors.clear()
+        self.loaded_objects.clear()
         for info in self.get_processor_subjects():
+            self.processors[info.uri] = info.obj()
             event_uris = info.values('on')
             for event_uri in event_uris:
                 self.register_event(event_uri, info)
-            self.processors[info.uri] = info.obj()
-
-    def register_event(self, event_uri, info: 'Subject'):
-        method_name = info.value('default-method', 'run')
-        events_to_raise = info.values('raise')
-
-        class _wrapper:
-            def __init__(self, func, events, node):
-                self.func = func
-                self.events = events
-                self.node = node
 
-            def __call__(self, *args, **kwargs):
-                self.func(*args, **kwargs)
-                for e in self.events:
-                    self.node.emit(e)
+    def load_views(self):
+        for uri in self.config.snapshot().subjects_with(NodeConstants.query_type):
+            info = self.config.subject(uri)
+            if info.value('materialize', False):
+                self.store.views[uri] = MaterializedView(self.store, uri, info.value('refresh', 'lazy'))
 
-        method_to_call = getattr(info.obj(), method_name)
-        self.on(event_uri, _wrapper(method_to_call, events_to_raise, self))
+    def register_event(self, event_uri, info: 'Subject'):
+        processor = self.processors[info.uri] if info.uri in self.processors else info.obj()
+        method_to_call = getattr(processor, info.value('default-method', 'run'))
+        events_to_raise = [str(ensure(e, self.uri_stub)) for e in info.values('raise')]
+        self.pipeline.add(str(ensure(event_uri, self.uri_stub)), info.uri, method_to_call, events_to_raise)
 
     def add_data(self, s, p, o):
         self.store.add(s, p, o)
@@ -102,11 +159,11 @@ class LdNode:
         self.bus.on(str(event), func)
 
     def emit(self, event, *args, **kwargs):
-        event = ensure(event, self.uri_stub)
-        if self.running_async:
-            self.bus.emit_async(str(event), *args, **kwargs)
-        else:
-            self.bus.emit(str(event), *args, **kwargs)
+        self.emit_except(event, None, *args, **kwargs)
+
+    def emit_except(self, event, skip, *args, **kwargs):
+        """emits event to its listeners other than skip"""
+        self.bus.emit_except(str(ensure(event, self.uri_stub)), skip, self.running_async, args, kwargs)
 
     def value(self, subject, predicate):
         return self.store.value(ensure(subject, self.uri_stub), ensure(predicate, self.uri_stub))
@@ -115,6 +172,14 @@ class LdNode:
         triple = (ensure(subject, self.uri_stub), ensure(predicate, self.uri_stub), ensure(obj))
         return self.store.filter(triple)
 
+    def snapshot(self) -> 'ConfigSnapshot':
+        generation = self.store.generation
+        snapshot = self.config_snapshot
+        if snapshot is None or snapshot.generation != generation:
+            snapshot = ConfigSnapshot(self.store, generation)
+            self.config_snapshot = snapshot
+        return snapshot
+
     def subject(self, name) -> 'Subject':
         return Subject(ensure(name, NodeConstants.config_uri_stub), self)
 
@@ -122,10 +187,46 @@ class LdNode:
         return self.subject(name).obj()
 
 
-class Bus:
+class EventQueue:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = deque()
+        self.keys = set()
+        self.max_depth = 0
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+
+class ListenerStats:
     def __init__(self):
-        self.pool = ThreadPoolExecutor(5)
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.total_wait = 0.0
+
+
+class Bus:
+    """runs async events on a fixed set of worker threads. every event has its own bounded queue, an emit of a
+    listener that is already queued with the same arguments is coalesced into the queued call. a full queue
+    blocks the emitter ('block'), drops the new call ('drop-newest') or drops the oldest queued one ('drop-oldest').
+    workers never block on a full queue as that could deadlock the bus, they go over the bound instead"""
+    policies = ('block', 'drop-newest', 'drop-oldest')
+
+    def __init__(self, workers=5, queue_size=100, policy='block'):
+        if policy not in Bus.policies:
+            raise Exception(f'unknown bus policy {policy}, use one of {Bus.policies}')
         self.listeners = {}
+        self.workers = workers
+        self.queue_size = queue_size
+        self.policy = policy
+        self.queues: Dict[str, EventQueue] = {}
+        self.listener_stats: Dict[str, ListenerStats] = {}
+        self.condition = threading.Condition()
+        self.threads = []
+        self.running = False
+        self.next_queue = 0
 
     def on(self, event, func=None):
         if event not in self.listeners:
@@ -133,16 +234,378 @@ class Bus:
         self.listeners[event].append(func)
 
     def emit(self, event, *args, **kwargs):
-        if event not in self.listeners:
-            return
-        for listener in self.listeners[event]:
-            listener(*args, **kwargs)
+        self.emit_except(event, None, False, args, kwargs)
 
     def emit_async(self, event, *args, **kwargs):
-        if event not in self.listeners:
+        self.emit_except(event, None, True, args, kwargs)
+
+    def emit_except(self, event, skip, run_async, args=(), kwargs=None):
+        """emits event to its listeners other than skip"""
+        kwargs = {} if kwargs is None else kwargs
+        mode = 'async' if run_async else 'sync'
+        events_emitted.inc(event=event, mode=mode)
+        metrics.trace('emit', event=event, mode=mode)
+        listeners = [x for x in self.listeners.get(event, ()) if x is not skip]
+        if len(listeners) == 0:
+            return
+        if run_async:
+            self.start()
+            for listener in listeners:
+                self.submit(event, listener, args, kwargs)
+            return
+        for listener in listeners:
+            started = time.perf_counter()
+            failed = True
+            try:
+                listener(*args, **kwargs)
+                failed = False
+            finally:
+                self.record(event, listener, 0.0, time.perf_counter() - started, failed)
+
+    @staticmethod
+    def coalesce_key(listener, args, kwargs):
+        key = (id(listener), args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def submit(self, event, listener, args, kwargs):
+        key = self.coalesce_key(listener, args, kwargs)
+        with self.condition:
+            if event not in self.queues:
+                self.queues[event] = EventQueue(self.queue_size)
+            queue = self.queues[event]
+            if key is not None and key in queue.keys:
+                queue.coalesced += 1
+                events_queued.inc(event=event, outcome='coalesced')
+                return
+            in_worker = threading.current_thread() in self.threads
+            while len(queue.items) >= queue.max_size and not in_worker and self.running:
+                if self.policy == 'drop-newest':
+                    queue.dropped += 1
+                    events_queued.inc(event=event, outcome='dropped')
+                    return
+                if self.policy == 'drop-oldest':
+                    queue.keys.discard(queue.items.popleft()[0])
+                    queue.dropped += 1
+                    events_queued.inc(event=event, outcome='dropped')
+                else:
+                    self.condition.wait()
+            queue.items.append((key, listener, args, kwargs, time.perf_counter(), event))
+            if key is not None:
+                queue.keys.add(key)
+            queue.submitted += 1
+            events_queued.inc(event=event, outcome='queued')
+            queue.max_depth = max(queue.max_depth, len(queue.items))
+            self.condition.notify_all()
+
+    def take(self):
+        """the next queued call, taking the event queues in turn so one busy event can not starve the others"""
+        queues = list(self.queues.values())
+        for i in range(len(queues)):
+            queue = queues[(self.next_queue + i) % len(queues)]
+            if len(queue.items) > 0:
+                self.next_queue = (self.next_queue + i + 1) % len(queues)
+                item = queue.items.popleft()
+                queue.keys.discard(item[0])
+                return item
+        return None
+
+    def work(self):
+        while True:
+            with self.condition:
+                item = self.take()
+                while item is None and self.running:
+                    self.condition.wait()
+                    item = self.take()
+                if item is None:
+                    return
+                self.condition.notify_all()
+            key, listener, args, kwargs, queued_at, event = item
+            started = time.perf_counter()
+            failed = False
+            try:
+                listener(*args, **kwargs)
+            except Exception as e:
+                failed = True
+                print(f'{self.listener_name(listener)} failed: {e}')
+            self.record(event, listener, started - queued_at, time.perf_counter() - started, failed)
+
+    @staticmethod
+    def listener_name(listener):
+        listener = getattr(listener, 'func', listener)
+        return getattr(listener, '__qualname__', repr(listener))
+
+    def record(self, event, listener, wait, took, failed):
+        name = self.listener_name(listener)
+        listener_seconds.observe(took, event=event, listener=name)
+        if wait > 0:
+            listener_wait.observe(wait, event=event)
+        if failed:
+            listener_errors.inc(event=event, listener=name)
+        metrics.trace('listener', event=event, listener=name, wait=wait, took=took, failed=failed)
+        with self.condition:
+            if name not in self.listener_stats:
+                self.listener_stats[name] = ListenerStats()
+            stats = self.listener_stats[name]
+            stats.calls += 1
+            stats.errors += 1 if failed else 0
+            stats.total_wait += wait
+            stats.total_time += took
+            stats.max_time = max(stats.max_time, took)
+
+    def start(self):
+        if self.running:
+            return
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+            self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def depths(self):
+        with self.condition:
+            return {event: len(q.items) for event, q in self.queues.items()}
+
+    def stats(self):
+        with self.condition:
+            return {
+                'queues': {event: {'depth': len(q.items), 'max-depth': q.max_depth, 'submitted': q.submitted,
+                                   'coalesced': q.coalesced, 'dropped': q.dropped}
+                           for event, q in self.queues.items()},
+                'listeners': {name: {'calls': x.calls, 'errors': x.errors, 'max-time': x.max_time,
+                                     'mean-time': x.total_time / x.calls if x.calls else 0.0,
+                                     'mean-wait': x.total_wait / x.calls if x.calls else 0.0}
+                              for name, x in self.listener_stats.items()}
+            }
+
+class Pipeline:
+    """the processors of a node as a dag, with an edge from a processor to each processor that is c:on one of the
+    events it c:raise-s. an event emitted from outside the pipeline starts a wave: the processors it reaches run as
+    soon as all their upstream processors of that wave are done, independent branches at the same time on the
+    pipeline's threads (inline when the node does not run async). a processor runs once per wave however many of
+    its inputs fired, and not at all when all of them failed. raised events still reach the other listeners"""
+    def __init__(self, node: LdNode, workers=5):
+        self.node = node
+        self.workers = workers
+        self.executor = None
+        self.listeners: Dict[str, List[r.URIRef]] = {}  # event -> processors c:on it
+        self.calls: Dict[r.URIRef, Any] = {}
+        self.raises: Dict[r.URIRef, List[str]] = {}
+        self.successors: Dict[r.URIRef, List[r.URIRef]] = {}
+        self.triggers: Dict[str, 'PipelineTrigger'] = {}
+        self.lock = threading.RLock()
+
+    def add(self, event, uri, call, raises):
+        """makes the processor uri a listener of event, raises when that closes a cycle"""
+        with self.lock:
+            listeners = self.listeners.setdefault(event, [])
+            if uri in listeners:
+                return
+            listeners.append(uri)
+            self.calls[uri], self.raises[uri] = call, raises
+            try:
+                self.link()
+            except Exception:
+                listeners.remove(uri)
+                self.link()
+                raise
+            if event not in self.triggers:
+                self.triggers[event] = PipelineTrigger(self, event)
+                self.node.bus.on(event, self.triggers[event])
+
+    def link(self):
+        successors = {uri: list(dict.fromkeys(x for e in events for x in self.listeners.get(e, ())))
+                      for uri, events in self.raises.items()}
+        cycle = self.find_cycle(successors)
+        if cycle is not None:
+            raise Exception(f'the processors form a cycle: {" -> ".join(str(x) for x in cycle)}')
+        self.successors = successors
+
+    @staticmethod
+    def find_cycle(successors):
+        state = {}  # 1 while on the path, 2 when done
+
+        def visit(uri, path):
+            state[uri] = 1
+            path.append(uri)
+            for successor in successors.get(uri, ()):
+                if state.get(successor) == 1:
+                    return path[path.index(successor):] + [successor]
+                if successor not in state:
+                    cycle = visit(successor, path)
+                    if cycle is not None:
+                        return cycle
+            path.pop()
+            state[uri] = 2
+            return None
+
+        for uri in successors:
+            if uri not in state:
+                cycle = visit(uri, [])
+                if cycle is not None:
+                    return cycle
+        return None
+
+    def start(self, event, args, kwargs):
+        with self.lock:
+            roots = list(self.listeners.get(event, ()))
+            wave = Wave(self, roots, self.successors, args, kwargs)
+        waves_started.inc(event=event)
+        wave.start()
+
+    def run(self, func, *args):
+        if not self.node.running_async:
+            func(*args)
+            return
+        self.submit(func, *args)
+
+    def submit(self, func, *args):
+        """runs func on the pipeline's threads, also when the node does not run async"""
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='pipeline')
+        self.executor.submit(func, *args)
+
+
+class PipelineTrigger:
+    """the bus listener of an event some processors are c:on, starts a wave of the pipeline"""
+    def __init__(self, pipeline: Pipeline, event):
+        self.pipeline = pipeline
+        self.event = event
+
+    def __call__(self, *args, **kwargs):
+        self.pipeline.start(self.event, args, kwargs)
+
+    def __repr__(self):
+        return f'pipeline {self.event}'
+
+
+class Wave:
+    """one run through the part of the dag an event reaches"""
+    def __init__(self, pipeline: Pipeline, roots, successors, args, kwargs):
+        self.pipeline = pipeline
+        self.roots = set(roots)
+        self.args = args
+        self.kwargs = kwargs
+        self.successors = successors
+        reached, stack = set(), list(roots)
+        while len(stack) > 0:
+            uri = stack.pop()
+            if uri not in reached:
+                reached.add(uri)
+                stack.extend(successors.get(uri, ()))
+        # the upstream processors of the wave each processor still waits for
+        self.waiting = {uri: 0 for uri in reached}
+        for uri in reached:
+            for successor in successors.get(uri, ()):
+                self.waiting[successor] += 1
+        self.triggered = set(roots)
+        self.lock = threading.Lock()
+
+    def start(self):
+        for uri in [x for x, n in self.waiting.items() if n == 0]:
+            self.pipeline.run(self.call, uri)
+
+    def call(self, uri):
+        started = time.perf_counter()
+        func = self.pipeline.calls[uri]
+        try:
+            if uri in self.roots:
+                result = func(*self.args, **self.kwargs)
+            else:
+                result = func()
+        except Exception as e:
+            self.done(uri, started, e)
             return
-        for listener in self.listeners[event]:
-            self.pool.submit(lambda: listener(*args, **kwargs))
+        # web's star import brings asyncio's Future, a processor's future is a concurrent one
+        if isinstance(result, concurrent.futures.Future):
+            # the processor finishes on another thread, the wave goes on when it has
+            result.add_done_callback(lambda x: self.finished(uri, started, x))
+        else:
+            self.done(uri, started)
+
+    def finished(self, uri, started, future: concurrent.futures.Future):
+        """runs on the thread that finished the future (the fetch loop for a consumer), which must not run the
+        processors downstream, so the wave goes on on the pipeline's threads"""
+        error = Exception('cancelled') if future.cancelled() else future.exception()
+        self.pipeline.submit(self.done, uri, started, error)
+
+    def done(self, uri, started, error=None):
+        processor_seconds.observe(time.perf_counter() - started, processor=uri,
+                                  method=getattr(self.pipeline.calls[uri], '__name__', 'run'))
+        metrics.trace('processor', processor=uri, took=time.perf_counter() - started, failed=error is not None)
+        if error is not None:
+            processor_errors.inc(processor=uri)
+            print(f'{uri} failed: {error}')
+        else:
+            for event in self.pipeline.raises[uri]:
+                self.pipeline.node.emit_except(event, self.pipeline.triggers.get(event))
+        self.finish(uri, error is None)
+
+    def finish(self, uri, succeeded):
+        ready = []
+        with self.lock:
+            for successor in self.successors.get(uri, ()):
+                if succeeded:
+                    self.triggered.add(successor)
+                self.waiting[successor] -= 1
+                if self.waiting[successor] == 0:
+                    ready.append(successor)
+        for successor in ready:
+            if successor in self.triggered:
+                self.pipeline.run(self.call, successor)
+            else:
+                self.finish(successor, False)
+
+
+class ConfigSnapshot:
+    """a read only view of a store for one generation, the properties of a subject are read from the store once
+    and then served from a dict. a new snapshot is made when the store changes"""
+    def __init__(self, store: Store, generation):
+        self.store = store
+        self.generation = generation
+        self.subjects: Dict[r.URIRef, Dict[r.URIRef, Tuple]] = {}
+        self.objects: Dict[r.URIRef, Tuple] = {}
+
+    def properties(self, subject):
+        properties = self.subjects.get(subject)
+        if properties is None:
+            values = {}
+            for _, p, o in self.store.filter((subject, None, None)):
+                values.setdefault(p, []).append(o)
+            properties = {p: tuple(o) for p, o in values.items()}
+            self.subjects[subject] = properties
+        return properties
+
+    def values(self, subject, predicate):
+        return self.properties(subject).get(predicate, ())
+
+    def value(self, subject, predicate):
+        values = self.values(subject, predicate)
+        return values[0] if len(values) > 0 else None
+
+    def subjects_with(self, obj):
+        subjects = self.objects.get(obj)
+        if subjects is None:
+            subjects = tuple(dict.fromkeys(t[0] for t in self.store.filter((None, None, obj))))
+            self.objects[obj] = subjects
+        return subjects
+
+
+@lru_cache(maxsize=1024)
+def config_predicate(prop):
+    return ensure(prop, NodeConstants.config_uri_stub)
+
 
 # todo: extract as interface and allow subject just to be an object/dictionary as well
 class Subject:
@@ -152,8 +615,8 @@ class Subject:
         self.parent = parent
 
     def value(self, prop, default_value=None, allow_none = False):
-        predicate = ensure(prop, NodeConstants.config_uri_stub)
-        value = self.node.store.value(self.uri, predicate)
+        predicate = config_predicate(prop)
+        value = self.node.snapshot().value(self.uri, predicate)
         if value is not None:
             return self.obj_for_item(value)
         if self.parent is not None:
@@ -167,25 +630,25 @@ class Subject:
             raise Exception(f'{predicate} does not exist on {self.uri} in {self.node.uri}')
 
     def values(self, prop):
-        predicate = ensure(prop, NodeConstants.config_uri_stub)
-        values = self.node.store.filter((self.uri, predicate, None))
-        return [x[2] for x in values]
+        return list(self.node.snapshot().values(self.uri, config_predicate(prop)))
 
     def obj(self):
         return self.obj_for_item(self.uri)
 
     def obj_for_item(self, item):
-        if item in self.node.parent.processors:
-            return self.node.parent.processors[item]
+        # every object is built once and shared through the registry of the node that owns the config
+        owner = self.node if self.node.parent is None else self.node.parent
+        if item in owner.loaded_objects:
+            return owner.loaded_objects[item]
         if type(item) is r.URIRef:
-            if item in self.node.loaded_objects:
-                return self.node.loaded_objects[item]
-            else:
-                class_name = self.node.value(item, 'class-name')
-                if class_name is None:
-                    return item
-                else:
-                    return get_class(class_name, self.node.parent, self)
+            class_name = self.node.snapshot().value(item, config_predicate('class-name'))
+            if class_name is None:
+                return item
+            with owner.registry_lock:
+                if item not in owner.loaded_objects:
+                    config = self if item == self.uri else Subject(item, self.node)
+                    owner.loaded_objects[item] = get_class(class_name, owner, config)
+                return owner.loaded_objects[item]
         elif type(item) is r.Literal:
             return item.value
         else:
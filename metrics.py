@@ -0,0 +1,176 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+default_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise Exception(f'{self.name} has the labels {self.labels}, not {tuple(labels)}')
+        return tuple(str(labels[x]) for x in self.labels)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        for name, key, value in self.samples():
+            lines.append(f'{name}{format_labels(self.labels, key)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=default_buckets):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # a count per bucket, then the sum and the count of all observations
+                counts = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        names = self.labels + ('le',)
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+        for key, counts in values:
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{format_labels(names, key + (bound,))} {count}')
+            lines.append(f'{self.name}_bucket{format_labels(names, key + ("+Inf",))} {counts[-1]}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {counts[-2]}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, key)} {counts[-1]}')
+        return lines
+
+
+class Registry:
+    """the metrics of the process. collectors are called on every scrape to set gauges of things that are
+    cheaper to read when asked for (queue depths, store sizes) than to keep up to date"""
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, help_text, labels=(), **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help_text, labels, **kwargs)
+            elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+                raise Exception(f'the metric {name} is already registered as another kind or with other labels')
+            return metric
+
+    def collect(self, collector):
+        with self.lock:
+            self.collectors.append(collector)
+
+    def render(self):
+        for collector in list(self.collectors):
+            try:
+                collector()
+            except Exception as e:
+                print(f'metrics collector failed: {e}')
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in sorted(metrics, key=lambda x: x.name):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class TraceLog:
+    """writes a json line per traced event to a file, off unless a file is set (c:trace-file)"""
+    def __init__(self):
+        self.file = None
+        self.lock = threading.Lock()
+
+    def open(self, file_name):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.file = None if file_name is None else open(file_name, 'a', buffering=1)
+
+    def write(self, kind, **fields):
+        if self.file is None:
+            return
+        line = json.dumps(dict(time=time.time(), kind=kind, **fields), default=str)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line + '\n')
+
+
+registry = Registry()
+trace_log = TraceLog()
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def counter(name, help_text, labels=()) -> Counter:
+    return registry.get(Counter, name, help_text, labels)
+
+
+def gauge(name, help_text, labels=()) -> Gauge:
+    return registry.get(Gauge, name, help_text, labels)
+
+
+def histogram(name, help_text, labels=(), buckets=default_buckets) -> Histogram:
+    return registry.get(Histogram, name, help_text, labels, buckets=buckets)
+
+
+def trace(kind, **fields):
+    trace_log.write(kind, **fields)
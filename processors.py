@@ -1,31 +1,126 @@
+import heapq
 import threading
 import time
 from datetime import datetime
-from typing import Dict
+from typing import Dict, List, Tuple
 import rdflib as r
 from croniter import croniter
+from dateutil import tz
+import metrics
 from ldnode import Subject
-from rdfops import NodeConstants
+from rdfops import NodeConstants, Derivations, prepare_query, find_names, find_bgps, fill_patterns, \
+    non_monotonic_parts
 
 
 class ConstructProcessor:
     def __init__(self, config: Subject = None):
         self.query = config.value('query', config.uri)
         self.node = config.node.parent
+        self.incremental = IncrementalConstruct(self.node.store, self.query) \
+            if config.value('incremental', False) else None
 
     def run(self):
+        if self.incremental is not None and self.incremental.run():
+            self.node.emit('construct_complete')
+            return
         results = self.node.store.query(self.query)
-        for result in results:
-            self.node.store.add_triple(result)
+        self.node.store.add_many(results)
         self.node.emit('construct_complete')
 
 
+class IncrementalConstruct:
+    """semi-naive evaluation of a CONSTRUCT: after a first full run, only the solutions that use at least one
+    triple written since the last run are evaluated, by binding each triple pattern of the query to each new
+    triple it matches. for every constructed triple the source triples of each of its solutions are kept, when
+    all the solutions of a constructed triple have lost a source triple it is removed again.
+    queries that are not monotonic (OPTIONAL, MINUS, (NOT) EXISTS, aggregates, LIMIT) are run in full"""
+    non_monotonic = non_monotonic_parts | {'OrderBy'}
+
+    def __init__(self, store, query_uri):
+        self.store = store
+        self.query_uri = query_uri
+        self.delta = None
+        self.sparql = None
+        self.query = None
+        self.derivations = Derivations()  # of the constructed triples
+        self.owned = set()  # constructed triples that were not in the store before we added them
+        self.lock = threading.Lock()
+
+    def run(self):
+        """returns False when the query can not be run incrementally"""
+        with self.lock:
+            sparql = str(self.store.value(self.query_uri, NodeConstants.sparql_predicate))
+            if sparql != self.sparql:
+                self.prepare(sparql)
+            if self.query is None:
+                return False
+            if self.delta is None:
+                self.delta = self.store.track()
+                with self.store.transaction():
+                    self.apply(self.store.solutions(self.query))
+            added, removed = self.delta.take()
+            while len(added) > 0 or len(removed) > 0:
+                with self.store.transaction():
+                    self.retract(removed)
+                    self.apply(self.solutions_with(added))
+                added, removed = self.delta.take()
+            return True
+
+    def prepare(self, sparql):
+        self.sparql = sparql
+        if self.delta is not None:
+            # nothing derives what the old query constructed any more, and its writes need no more recording
+            with self.store.transaction() as batch:
+                self.store.untrack(self.delta)
+                batch.remove_many(self.owned)
+            self.delta = None
+        self.derivations.clear()
+        self.owned.clear()
+        query, bindings = prepare_query(self.store, self.query_uri)
+        if query.algebra.name != 'ConstructQuery' or bindings or find_names(query.algebra.p) & self.non_monotonic \
+                or any(isinstance(x, r.BNode) for t in query.algebra.template for x in t):
+            self.query = None
+            return
+        self.query = query
+        self.derivations.patterns = [t for bgp in find_bgps(query.algebra.p) for t in bgp.triples]
+
+    def solutions_with(self, added):
+        return self.derivations.solutions_with(added, lambda bindings: self.store.solutions(self.query, bindings))
+
+    def apply(self, solutions):
+        # solutions are read in full before anything is written to the graph they come from
+        for solution in list(solutions):
+            sources = self.derivations.sources(solution, self.store.contains)
+            for triple in fill_patterns(self.query.algebra.template, solution):
+                if self.derivations.add(triple, sources) and not self.store.contains(triple):
+                    self.owned.add(triple)
+                    self.store.add_triple(triple)
+
+    def retract(self, removed):
+        for triple in self.derivations.retract(removed):
+            if triple in self.owned:
+                self.owned.discard(triple)
+                self.store.remove_triple(triple)
+
+
+scheduler_lag = metrics.histogram('ldnode_scheduler_lag_seconds', 'how late a scheduled run fired',
+                                  ('processor',))
+
+
 class Scheduler:
+    """keeps the next fire time of every scheduled processor in a heap and sleeps until the first one is due.
+    the processors are only read again when the config store changes (checked every c:config-check seconds).
+    'poll' processors fire every c:sleep-for seconds"""
     def __init__(self, config: Subject):
         self.node = config.node.parent
         self.config = config
         self.node.on('run-scheduler', self.run_once)
-        self.schedules: Dict[r.URIRef, datetime] = {} #todo: need to handle cron changes
+        self.schedules: Dict[r.URIRef, str] = {}
+        self.heap: List[Tuple[float, int, r.URIRef]] = []
+        self.registered = set()
+        self.config_generation = None
+        self.condition = threading.Condition()
+        self.sequence = 0
         self.node.on('after-started', self.start)
         self.node.on('before-stop', self.stop)
         self.running = False
@@ -38,30 +133,71 @@ class Scheduler:
         self.node.emit('scheduler-started')
 
     def stop(self):
-        self.running = False
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def reschedule(self):
+        """forces a rebuild of the schedule on the next wake up"""
+        with self.condition:
+            self.config_generation = None
+            self.condition.notify_all()
 
     def run(self):
         print('scheduler loop started')
+        config_check = float(self.config.value('config-check', 1.0))
         while self.running:
             self.run_once()
-            # this creates a loop
-            time.sleep(self.config.value('sleep-for', 0.1))
+            with self.condition:
+                if not self.running:
+                    break
+                delay = config_check if len(self.heap) == 0 else self.heap[0][0] - time.time()
+                if delay > 0:
+                    self.condition.wait(min(delay, config_check))
         print('scheduler loop stopped')
 
     def run_once(self):
+        self.refresh()
+        now = time.time()
+        due = []
+        with self.condition:
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                due_at, _, uri = heapq.heappop(self.heap)
+                if uri in self.schedules:
+                    scheduler_lag.observe(now - due_at, processor=uri)
+                    due.append(uri)
+                    self.push(uri, self.next_run(self.schedules[uri], now))
+        for uri in due:
+            self.node.emit(str(uri) + "-schedule-run")
+
+    def refresh(self):
+        generation = self.node.config.store.generation
+        if generation == self.config_generation:
+            return
+        schedules = {}
         for info in self.node.get_processor_subjects():
-            self.check_processor_run(info)
-
-    def check_processor_run(self, info):
-        cron = info.value(NodeConstants.cron_predicate, 'none')
-        if cron != 'none':
-            uri = info.uri
-            run_event = str(uri) + "-schedule-run"
-            next_run = self.schedules[uri] if uri in self.schedules else None
-            now = datetime.now()
-            if next_run is None or now >= next_run:
-                if next_run is None:
-                    self.node.register_event(run_event, info)
-                next_next_run = None if cron == 'poll' else croniter(cron, now).next(datetime)
-                self.schedules[uri] = next_next_run
-                self.node.emit(run_event)
\ No newline at end of file
+            cron = info.value(NodeConstants.cron_predicate, 'none')
+            if cron != 'none':
+                schedules[info.uri] = cron
+                if info.uri not in self.registered:
+                    self.node.register_event(str(info.uri) + "-schedule-run", info)
+                    self.registered.add(info.uri)
+        with self.condition:
+            changed = [uri for uri in schedules if self.schedules.get(uri) != schedules[uri]]
+            self.schedules = schedules
+            # entries of removed processors are skipped when they come off the heap
+            self.heap = [x for x in self.heap if x[2] in schedules and x[2] not in changed]
+            heapq.heapify(self.heap)
+            for uri in changed:
+                self.push(uri, time.time())
+            self.config_generation = generation
+
+    def push(self, uri, next_run):
+        self.sequence += 1
+        heapq.heappush(self.heap, (next_run, self.sequence, uri))
+
+    def next_run(self, cron, now):
+        if cron == 'poll':
+            return now + float(self.config.value('sleep-for', 0.1))
+        # croniter reads a naive start as utc, the start is local so the cron fields are local times
+        return croniter(cron, datetime.fromtimestamp(now, tz.tzlocal())).get_next(datetime).timestamp()
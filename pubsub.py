@@ -1,10 +1,34 @@
 import ast
+import asyncio
+import copy
 import csv
-from typing import Dict, Any
+import hashlib
+import io
+import json
+import locale
+import mmap
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from email.utils import formatdate, parsedate_to_datetime
+from glob import glob
+from itertools import islice
+from typing import Dict, Any, Callable, List, Optional, Tuple
 import rdflib as r
+import fetch
+import metrics
+import rdfbin
 from ldnode import Subject
 from rdfops import compiler, ensure
 from dateutil.parser import parse
+from web import etag_matches, ChunkStream, stream_from_thread
 
 
 def guess_type(value):
@@ -22,32 +46,177 @@ def guess_type(value):
                 return value
 
 
+class TypeInference:
+    """picks one datatype per column from a sample of its values (integer, decimal, date, dateTime or string)
+    and returns a single converter for the column. values that do not fit go to the fallback:
+    'guess' (guess_type on that value), 'string' (keep the text) or 'skip' (drop the cell)"""
+    integer = re.compile(r'^[+-]?\d+$')
+    decimal = re.compile(r'^[+-]?(\d+\.\d*|\.\d+)$')
+    date_like = re.compile(r'^[\w\s,:./+-]{4,40}$')
+    date_formats = ['%Y-%m-%d', '%d-%m-%Y', '%m-%d-%Y', '%d/%m/%Y', '%m/%d/%Y', '%Y/%m/%d', '%d.%m.%Y',
+                    '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%d %H:%M',
+                    '%d/%m/%Y %H:%M:%S', '%m/%d/%Y %H:%M:%S', '%d-%m-%Y %H:%M:%S']
+
+    def __init__(self, sample_size=100, fallback='guess'):
+        self.sample_size = sample_size
+        if fallback not in ('guess', 'string', 'skip'):
+            raise Exception(f'unknown type fallback {fallback}, use guess, string or skip')
+        self.fallback = fallback
+
+    def infer(self, values):
+        """returns (datatype name, converter) for the sampled values of a column"""
+        values = [x for x in values[:self.sample_size] if type(x) is str and x != '']
+        if len(values) == 0:
+            return 'string', self.no_change
+        if all(self.integer.match(x) for x in values):
+            return 'integer', self.converter(int)
+        if all(self.integer.match(x) or self.decimal.match(x) for x in values):
+            return 'decimal', self.converter(Decimal)
+        dates = self.parse_dates(values)
+        if dates is not None:
+            has_time = any(x.time() != datetime.min.time() or x.tzinfo is not None for x in dates)
+            date_format = self.find_date_format(values, dates)
+            if date_format is not None:
+                def convert_date(value):
+                    return datetime.strptime(value, date_format)
+            else:
+                convert_date = parse
+            if has_time:
+                return 'dateTime', self.converter(convert_date)
+            return 'date', self.converter(lambda value: convert_date(value).date())
+        return 'string', self.no_change
+
+    def parse_dates(self, values):
+        dates = []
+        for value in values:
+            if not self.date_like.match(value) or not any(c.isdigit() for c in value):
+                return None
+            try:
+                dates.append(parse(value))
+            except (ValueError, OverflowError):
+                return None
+        return dates
+
+    def find_date_format(self, values, dates):
+        for date_format in self.date_formats:
+            try:
+                if all(datetime.strptime(v, date_format) == d for v, d in zip(values, dates)):
+                    return date_format
+            except ValueError:
+                continue
+        return None
+
+    @staticmethod
+    def no_change(value):
+        return value
+
+    def converter(self, convert):
+        fallback = self.fallback
+
+        def convert_value(value):
+            if type(value) is not str or value == '':
+                return value
+            try:
+                return convert(value)
+            except (ValueError, InvalidOperation, OverflowError):
+                if fallback == 'guess':
+                    return guess_type(value)
+                if fallback == 'skip':
+                    return None
+                return value
+        return convert_value
+
+
+changeset_type = 'application/rdf-patch'
+
+
+def to_ntriple(triple):
+    return ' '.join(term_to_nt(x) for x in triple) + ' .\n'
+
+
+def term_to_nt(term):
+    if type(term) is not r.Literal:
+        return term.n3()
+    value = str(term).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r')
+    if term.language is not None:
+        return f'"{value}"@{term.language}'
+    if term.datatype is not None:
+        return f'"{value}"^^<{term.datatype}>'
+    return f'"{value}"'
+
+
 class Mapper:
-    def __init__(self, subject_template: str, uri_stub, type_uri=None, mappings: str = None, auto_guess_type=False):
+    def __init__(self, subject_template: str, uri_stub, type_uri=None, mappings: str = None, auto_guess_type=False,
+                 type_inference: TypeInference = None):
+        self.args = (subject_template, uri_stub, type_uri, mappings, auto_guess_type, type_inference)
         self.auto_guess_type = auto_guess_type
         self.subject_template = compiler.compile(subject_template)
         self.uri_stub = uri_stub
         self.type_uri = ensure(type_uri, uri_stub)
         self.mappings: dict[str, str] = None if mappings is None else ast.literal_eval(mappings)
+        self.type_inference = TypeInference() if type_inference is None else type_inference
+        self.column_types: Dict[Any, str] = {}  # the types of the last plan
+
+    def __reduce__(self):
+        # compiled templates can not be pickled, worker processes rebuild the mapper from its arguments
+        return Mapper, self.args
+
+    def compile_column(self, key, sample: Optional[List[Dict[str, Any]]]):
+        """returns (key, predicate, convert) where convert(row, value) gives the object of the cell. without a
+        sample every value has its type guessed on its own"""
+        predicate = ensure(key, self.uri_stub)
+        template = None
+        if self.mappings is not None and key in self.mappings:
+            template = compiler.compile(self.mappings[key])
+
+            def extract(row, value):
+                return eval(str(template(row)).replace('\'', '"'))
+        else:
+            def extract(row, value):
+                return value
+        if not self.auto_guess_type:
+            if template is None:
+                def convert(row, value):
+                    return ensure(value)
+            else:
+                def convert(row, value):
+                    return ensure(extract(row, value))
+            return key, predicate, convert
+
+        if sample is None:
+            to_type = guess_type
+        else:
+            values = [extract(row, row.get(key)) for row in sample[:self.type_inference.sample_size]]
+            self.column_types[key], to_type = self.type_inference.infer(values)
+        if template is None:
+            def convert(row, value):
+                return ensure(to_type(value))
+        else:
+            def convert(row, value):
+                return ensure(to_type(extract(row, value)))
+        return key, predicate, convert
+
+    def plan(self, header, sample: Optional[List[Dict[str, Any]]]) -> List[Tuple[Any, r.URIRef, Callable]]:
+        """the compiled columns for a header row with the column types of sample, made once per parse so a file
+        whose columns change type is not mapped with the types of an earlier parse"""
+        return [self.compile_column(key, sample) for key in header if key is not None]
 
     def to_rdf(self, row: Dict[str, Any]):
+        # one row is no sample to infer column types from
+        return self.to_rdf_batch([row], list(row.keys()), self.plan(row.keys(), None))
+
+    def to_rdf_batch(self, rows: List[Dict[str, Any]], header, plan=None):
         result = []
-        subject = ensure(self.subject_template(row), self.uri_stub)
-        if self.type_uri is not None:
-            result.append((subject, r.RDF.type, self.type_uri))
-        for key, value in row.items():
-            s = ensure(subject, self.uri_stub)
-            p = ensure(key, self.uri_stub)
-            if self.mappings is not None and key in self.mappings:
-                mapping = self.mappings[key]
-                mapping = compiler.compile(mapping)(row)
-                mapping = str(mapping).replace('\'', '"')
-                value = eval(mapping)
-            if self.auto_guess_type:
-                value = guess_type(value)
-            o = ensure(value)
-            if o is not None:
-                result.append((s, p, o))
+        plan = self.plan(header, rows) if plan is None else plan
+        type_uri = self.type_uri
+        for row in rows:
+            subject = ensure(self.subject_template(row), self.uri_stub)
+            if type_uri is not None:
+                result.append((subject, r.RDF.type, type_uri))
+            for key, predicate, convert in plan:
+                o = convert(row, row.get(key))
+                if o is not None:
+                    result.append((subject, predicate, o))
         return result
 
 
@@ -61,7 +230,12 @@ class Target:
     def store(self, triples):
         pass
 
-    async def read(self, rsp):
+    def store_ntriples(self, text: str):
+        g = r.Graph()
+        g.parse(data=text, format='nt')
+        self.store(g)
+
+    async def read(self, rsp, request=None):
         pass
 
     def start(self):
@@ -79,19 +253,109 @@ class Parser:
     def parse(self, file_like):
         pass
 
+    def parse_file(self, file_path, new_line=''):
+        with open(file_path, newline=new_line) as this_file:
+            self.parse(this_file)
+
 
 class CsvParser(Parser):
-    def __init__(self, mapper: Mapper, writer: Target, delimiter=',', quote_char='|'):
+    def __init__(self, mapper: Mapper, writer: Target, delimiter=',', quote_char='|', batch_size=10000):
         super(CsvParser, self).__init__(mapper, writer)
         self.quote_char = quote_char
         self.delimiter = delimiter
+        self.batch_size = batch_size
 
     def parse(self, file_like):
         reader = csv.DictReader(file_like, delimiter=self.delimiter, quotechar=self.quote_char)
         self.writer.start()
-        for row in reader:
-            triples = self.mapper.to_rdf(row)
-            self.writer.store(triples)
+        plan = None
+        while True:
+            rows = list(islice(reader, self.batch_size))
+            if len(rows) == 0:
+                break
+            if plan is None:
+                plan = self.mapper.plan(reader.fieldnames, rows)
+            self.writer.store(self.mapper.to_rdf_batch(rows, reader.fieldnames, plan))
+        self.writer.end()
+
+    def with_writer(self, writer: Target):
+        parser = copy.copy(self)
+        parser.writer = writer
+        return parser
+
+
+def map_csv_chunk(mapper: Mapper, file_path, start, end, header, sample, delimiter, quote_char):
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode(locale.getpreferredencoding(False))
+    reader = csv.DictReader(io.StringIO(text, newline=''), fieldnames=header, delimiter=delimiter,
+                            quotechar=quote_char)
+    plan = mapper.plan(header, sample)
+    return ''.join(to_ntriple(t) for t in mapper.to_rdf_batch(list(reader), header, plan))
+
+
+def worker_context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+class ParallelCsvParser(CsvParser):
+    """splits the file into byte ranges on record ends and maps them in a process pool, the n-triples of each
+    range are handed to the writer in file order. the workers are started with forkserver (spawn where there is
+    none), forking the threads of a running node is not safe, so a script that parses must guard its main code"""
+    def __init__(self, mapper: Mapper, writer: Target, delimiter=',', quote_char='|', batch_size=10000,
+                 workers=os.cpu_count(), chunk_size=8 * 1024 * 1024):
+        super(ParallelCsvParser, self).__init__(mapper, writer, delimiter, quote_char, batch_size)
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+    def split(self, f, size):
+        """yields (start, end) byte ranges that start and end on a record boundary, skipping the header. the
+        records are read with the csv reader, a new line in a quoted value does not end a range"""
+        encoding = locale.getpreferredencoding(False)
+        offset = 0
+
+        def lines():
+            nonlocal offset
+            for line in f:
+                offset += len(line)
+                yield line.decode(encoding)
+
+        f.seek(0)
+        records = csv.reader(lines(), delimiter=self.delimiter, quotechar=self.quote_char)
+        next(records, None)
+        start = offset
+        for _ in records:
+            if offset - start >= self.chunk_size:
+                yield start, offset
+                start = offset
+        if start < offset:
+            yield start, offset
+
+    def read_head(self, file_path, new_line):
+        with open(file_path, newline=new_line) as this_file:
+            reader = csv.DictReader(this_file, delimiter=self.delimiter, quotechar=self.quote_char)
+            sample = list(islice(reader, self.mapper.type_inference.sample_size))
+            return reader.fieldnames, sample
+
+    def parse_file(self, file_path, new_line=''):
+        size = os.path.getsize(file_path)
+        if self.workers <= 1 or size <= self.chunk_size:
+            return super(ParallelCsvParser, self).parse_file(file_path, new_line)
+        header, sample = self.read_head(file_path, new_line)
+        if header is None:
+            return super(ParallelCsvParser, self).parse_file(file_path, new_line)
+        self.writer.start()
+        with open(file_path, 'rb') as f, ProcessPoolExecutor(self.workers, mp_context=worker_context()) as pool:
+            pending = []
+            for start, end in self.split(f, size):
+                pending.append(pool.submit(map_csv_chunk, self.mapper, file_path, start, end, header, sample,
+                                           self.delimiter, self.quote_char))
+                # keep a couple of chunks per worker in flight so memory stays bounded
+                if len(pending) >= self.workers * 2:
+                    self.writer.store_ntriples(pending.pop(0).result())
+            for future in pending:
+                self.writer.store_ntriples(future.result())
         self.writer.end()
 
 
@@ -101,8 +365,7 @@ class FileSource(Source):
         self.new_line = new_line
 
     def read(self, parser: Parser):
-        with open(self.file_path, newline=self.new_line) as this_file:
-            parser.parse(this_file)
+        parser.parse_file(self.file_path, self.new_line)
 
 
 class FileTarget(Target):
@@ -117,39 +380,488 @@ class FileTarget(Target):
         self.g.serialize(destination=self.file_name, format='turtle')
 
     def store(self, triples):
-        for t in triples:
-            self.g.add(t)
+        self.g.addN((s, p, o, self.g) for s, p, o in triples)
 
-    async def read(self, rsp):
+    async def read(self, rsp, request=None):
         return await rsp.file_stream(self.file_name)
 
 
+class NTriplesTarget(Target):
+    """writes each row to disk as n-triples as soon as it is mapped"""
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = None
+
+    def start(self):
+        self.file = open(self.file_name, 'w', encoding='utf-8')
+
+    def end(self):
+        self.file.close()
+
+    def store(self, triples):
+        self.file.writelines(to_ntriple(t) for t in triples)
+
+    def store_ntriples(self, text: str):
+        self.file.write(text)
+
+    async def read(self, rsp, request=None):
+        return await rsp.file_stream(self.file_name, mime_type='application/n-triples; charset=utf-8')
+
+
+class StreamTarget(Target):
+    """writes n-triples straight to the http response while the csv is being mapped on a worker thread"""
+    def __init__(self, loop, chunk_size=1000, max_chunks=16):
+        self.chunk_size = chunk_size
+        self.stream = ChunkStream(loop, 'application/n-triples; charset=utf-8', max_chunks)
+        self.lines = []
+        self.sent = 0
+
+    def start(self):
+        self.lines = []
+
+    def store(self, triples):
+        for t in triples:
+            self.lines.append(to_ntriple(t))
+        if len(self.lines) >= self.chunk_size:
+            self.flush()
+
+    def store_ntriples(self, text: str):
+        self.lines.append(text)
+        self.flush()
+
+    def end(self):
+        self.flush()
+
+    def flush(self):
+        if len(self.lines) > 0:
+            chunk = ''.join(self.lines).encode()
+            self.lines = []
+            self.stream.put(chunk)
+            self.sent += len(chunk)
+
+    async def read(self, rsp, request=None):
+        await self.stream.send(request)
+
+
+class BinaryTarget(Target):
+    """writes binary rdf (see rdfbin) to a file"""
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = None
+        self.writer: rdfbin.BinaryWriter = None
+
+    def start(self):
+        self.file = open(self.file_name, 'wb')
+        self.writer = rdfbin.BinaryWriter(self.file.write)
+
+    def store(self, triples):
+        self.writer.add_many(triples)
+
+    def end(self):
+        self.writer.close()
+        self.file.close()
+
+    async def read(self, rsp, request=None):
+        return await rsp.file_stream(self.file_name, mime_type=rdfbin.binary_type)
+
+
+class BinaryStreamTarget(Target):
+    """writes binary rdf straight to the http response, like StreamTarget does with n-triples"""
+    def __init__(self, loop, max_chunks=16):
+        self.stream = ChunkStream(loop, rdfbin.binary_type, max_chunks)
+        self.writer: rdfbin.BinaryWriter = None
+        self.sent = 0
+
+    def start(self):
+        self.writer = rdfbin.BinaryWriter(self.put)
+
+    def store(self, triples):
+        self.writer.add_many(triples)
+
+    def end(self):
+        self.writer.close()
+
+    def put(self, data):
+        self.stream.put(data)
+        self.sent += len(data)
+
+    async def read(self, rsp, request=None):
+        await self.stream.send(request)
+
+
+class TeeTarget(Target):
+    """hands the triples to several targets"""
+    def __init__(self, *targets: Target):
+        self.targets = targets
+
+    def start(self):
+        for target in self.targets:
+            target.start()
+
+    def store(self, triples):
+        triples = list(triples)
+        for target in self.targets:
+            target.store(triples)
+
+    def end(self):
+        for target in self.targets:
+            target.end()
+
+
+class FileWatcher:
+    """polls the mtime and size of a file and calls on_change when they move"""
+    def __init__(self, file_path, on_change, interval=1.0):
+        self.file_path = file_path
+        self.on_change = on_change
+        self.interval = interval
+        self.running = False
+        self.last = None
+
+    def stat(self):
+        try:
+            stat = os.stat(self.file_path)
+            return stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            return None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.last = self.stat()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            current = self.stat()
+            if current != self.last:
+                self.last = current
+                try:
+                    self.on_change()
+                except Exception as e:
+                    print(f'failed to handle the change of {self.file_path}: {e}')
+
+
+class PublisherCache:
+    """keeps the rendered output of a source file keyed by its (mtime, size, sha1), the key is stored next to the
+    output so a restart does not rebuild an unchanged file. the file is only hashed when its mtime or size move"""
+    locks: Dict[str, threading.Lock] = {}
+
+    def __init__(self, source_path, cache_file, build, history=10, companions=()):
+        self.source_path = source_path
+        self.cache_file = cache_file
+        self.companions = companions  # suffixes of other files build writes next to the output
+        self.key_file = cache_file + '.key'
+        self.build = build
+        self.history = history
+        self.lock = PublisherCache.locks.setdefault(os.path.abspath(cache_file), threading.Lock())
+        self.key = self.load_key()
+
+    def load_key(self):
+        if not os.path.exists(self.key_file) or not os.path.exists(self.cache_file):
+            return None
+        with open(self.key_file) as f:
+            return tuple(json.load(f))
+
+    def save_key(self, key):
+        with open(self.key_file + '.saving', 'w') as f:
+            json.dump(key, f)
+        os.replace(self.key_file + '.saving', self.key_file)
+        self.key = key
+
+    def hash(self):
+        sha = hashlib.sha1()
+        with open(self.source_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def current_key(self):
+        stat = os.stat(self.source_path)
+        if self.key is not None and tuple(self.key[:2]) == (stat.st_mtime_ns, stat.st_size):
+            return self.key
+        return stat.st_mtime_ns, stat.st_size, self.hash()
+
+    def refresh(self):
+        """rebuilds the output if the source changed, returns True when it did"""
+        with self.lock:
+            self.key = self.load_key()  # another publisher may share this output
+            key = self.current_key()
+            if self.key is not None and key[2] == self.key[2]:
+                if key != self.key:
+                    self.save_key(key)
+                return False
+            building = f'{self.cache_file}.{threading.get_ident()}.building'
+            self.build(building)
+            if self.key is not None:
+                self.write_changeset(self.key[2], key[2], building)
+            os.replace(building, self.cache_file)
+            for suffix in self.companions:
+                if os.path.exists(building + suffix):
+                    os.replace(building + suffix, self.cache_file + suffix)
+            self.save_key(key)
+            return True
+
+    def changeset_file(self, version):
+        return f'{self.cache_file}.{version}.changeset'
+
+    @staticmethod
+    def line_digest(line):
+        return hashlib.blake2b(line, digest_size=8).digest()
+
+    def line_digests(self, file_name):
+        with open(file_name, 'rb') as f:
+            return {self.line_digest(line) for line in f}
+
+    def write_changeset(self, old_version, new_version, new_file):
+        """writes the triples removed and added between the current output and new_file as an rdf patch"""
+        old_lines = self.line_digests(self.cache_file)
+        new_lines = self.line_digests(new_file)
+        saving = self.changeset_file(old_version) + '.saving'
+        with open(saving, 'wb') as out:
+            out.write(f'H id <urn:sha1:{new_version}> .\nH prev <urn:sha1:{old_version}> .\n'.encode())
+            with open(self.cache_file, 'rb') as f:
+                out.writelines(b'D ' + line for line in f if self.line_digest(line) not in new_lines)
+            with open(new_file, 'rb') as f:
+                out.writelines(b'A ' + line for line in f if self.line_digest(line) not in old_lines)
+        os.replace(saving, self.changeset_file(old_version))
+        changesets = sorted(glob(self.cache_file + '.*.changeset'), key=os.path.getmtime)
+        for old in changesets[:-self.history]:
+            os.remove(old)
+
+    def changesets_since(self, version):
+        """the changeset files leading from version to the current output, None when the history does not go back
+        that far"""
+        files = []
+        while self.key is not None and version != self.key[2]:
+            path = self.changeset_file(version)
+            if not os.path.exists(path) or len(files) >= self.history:
+                return None
+            files.append(path)
+            with open(path) as f:
+                version = f.readline().split('urn:sha1:')[1].split('>')[0]
+        return files
+
+    @property
+    def etag(self):
+        return None if self.key is None else f'"{self.key[2]}"'
+
+    @property
+    def last_modified(self):
+        return None if self.key is None else formatdate(self.key[0] / 1e9, usegmt=True)
+
+    def not_modified(self, request):
+        if self.key is None or request is None:
+            return False
+        if 'if-none-match' in request.headers:
+            return etag_matches(request, self.etag)
+        if 'if-modified-since' in request.headers:
+            try:
+                since = parsedate_to_datetime(request.headers['if-modified-since']).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(self.key[0] / 1e9) <= since
+        return False
+
+
+build_seconds = metrics.histogram('ldnode_publisher_build_seconds', 'time a publisher took to map its source',
+                                  ('publisher',))
+bytes_served = metrics.counter('ldnode_publisher_bytes_total', 'bytes a publisher sent', ('publisher', 'kind'))
+
+
 class Publisher:
     def __init__(self, config: Subject):
         subject_template = config.value('subject-template')
         uri_stub = config.value('uri-stub')
         type_uri = config.value('type', None, True)
         mappings = config.value('mappings', None, True)
-        self.mapper = Mapper(subject_template, uri_stub, type_uri, mappings, config.value('guess-types', None, True))
+        type_inference = TypeInference(int(config.value('type-sample', 100)), config.value('type-fallback', 'guess'))
+        self.mapper = Mapper(subject_template, uri_stub, type_uri, mappings, config.value('guess-types', None, True),
+                             type_inference)
         self.reader = FileSource(config.value('file'))
         self.source = FileTarget('test_data.ttl')
-        self.parser = CsvParser(self.mapper, self.source)
+        batch_size = int(config.value('batch-size', 10000))
+        workers = int(config.value('workers', 1))
+        if workers > 1:
+            self.parser = ParallelCsvParser(self.mapper, self.source, batch_size=batch_size, workers=workers,
+                                            chunk_size=int(config.value('chunk-size', 8 * 1024 * 1024)))
+        else:
+            self.parser = CsvParser(self.mapper, self.source, batch_size=batch_size)
         self.cache = config.value('cache', False)
+        self.stream = config.value('stream', False)
+        self.node = config.node.parent
+        self.name = str(config.uri)
+        self.changed_event = str(config.uri) + '-changed'
+        if self.cache:
+            name = str(config.uri).split('/')[-1]
+            cache_dir = config.value('cache-dir', os.path.join(tempfile.gettempdir(), 'ldnode'))
+            os.makedirs(cache_dir, exist_ok=True)
+            self.output = NTriplesTarget(os.path.join(cache_dir, name + '.nt'))
+            self.output_cache = PublisherCache(self.reader.file_path, self.output.file_name, self.build,
+                                               companions=('.rdfb',))
+            self.watcher = FileWatcher(self.reader.file_path, self.rebuild, float(config.value('watch-interval', 1.0)))
+            if config.value('watch', True):
+                self.node.on('after-started', self.watcher.start)
+                self.node.on('before-stop', self.watcher.stop)
 
     def run(self):
         if self.cache:
-            self.reader.read(self.parser)
+            self.rebuild()
+
+    def build(self, file_name):
+        # the binary copy is for consumers that accept it
+        with build_seconds.time(publisher=self.name):
+            self.reader.read(self.parser.with_writer(TeeTarget(NTriplesTarget(file_name),
+                                                               BinaryTarget(file_name + '.rdfb'))))
 
-    async def get_data(self, rsp):
-        if not self.cache:
+    def rebuild(self):
+        if self.output_cache.refresh():
+            self.node.emit(self.changed_event)
+
+    async def get_data(self, rsp, request=None):
+        if self.cache:
+            return await self.get_cached_data(rsp, request)
+        if self.stream or rdfbin.accepts(request):
+            return await self.stream_data(rsp, request)
+        with build_seconds.time(publisher=self.name):
             self.reader.read(self.parser)
+        if hasattr(self.parser.writer, 'file_name'):
+            bytes_served.inc(os.path.getsize(self.parser.writer.file_name), publisher=self.name, kind='full')
         return await self.parser.writer.read(rsp)
 
+    async def get_cached_data(self, rsp, request):
+        # normally the watcher has already rebuilt, this only stats the file
+        await asyncio.get_running_loop().run_in_executor(None, self.rebuild)
+        headers = {'ETag': self.output_cache.etag, 'Last-Modified': self.output_cache.last_modified, 'Vary': 'Accept'}
+        if self.output_cache.not_modified(request):
+            return rsp.empty(status=304, headers=headers)
+        since = None if request is None else request.args.get('since')
+        changesets = None if since is None else self.output_cache.changesets_since(since)
+        if changesets is not None:
+            bytes_served.inc(sum(os.path.getsize(x) for x in changesets), publisher=self.name, kind='changeset')
+            return await self.send_changesets(request, changesets, headers)
+        binary_file = self.output.file_name + '.rdfb'
+        if rdfbin.accepts(request) and os.path.exists(binary_file):
+            bytes_served.inc(os.path.getsize(binary_file), publisher=self.name, kind='binary')
+            return await rsp.file_stream(binary_file, mime_type=rdfbin.binary_type, headers=headers)
+        bytes_served.inc(os.path.getsize(self.output.file_name), publisher=self.name, kind='full')
+        return await rsp.file_stream(self.output.file_name, mime_type='application/n-triples; charset=utf-8',
+                                     headers=headers)
+
+    @staticmethod
+    async def send_changesets(request, changesets, headers):
+        stream = await request.respond(headers=headers, content_type=changeset_type + '; charset=utf-8')
+        for changeset in changesets:
+            with open(changeset, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 16), b''):
+                    await stream.send(block)
+        await stream.eof()
+
+    async def stream_data(self, rsp, request):
+        loop = asyncio.get_running_loop()
+        target = BinaryStreamTarget(loop) if rdfbin.accepts(request) else StreamTarget(loop)
+        parser = self.parser.with_writer(target)
+        try:
+            with build_seconds.time(publisher=self.name):
+                await stream_from_thread(request, target.stream, lambda stream: self.reader.read(parser))
+        finally:
+            bytes_served.inc(target.sent, publisher=self.name, kind='stream')
+
 
 class Consumer:
+    """keeps the store in sync with a publisher: sends the etag of what it loaded last and applies the changeset
+    the publisher sends back, or diffs a full download against what it loaded before. the download runs on the
+    shared fetch pool and the parsing on its parse threads, run returns a future that is done when the store is"""
     def __init__(self, config: Subject):
         self.node = config.node.parent
         self.url = config.value('target')
-
-    def run(self):
-        self.node.store.parse(source=self.url, format='turtle')
+        self.timeout = float(config.value('timeout', 60))
+        self.retries = int(config.value('retries', 3))
+        self.backoff = float(config.value('backoff', 0.5))
+        node_config = self.node.config_instance
+        self.pool = fetch.get_pool(int(node_config.value('fetch-per-host', 4)),
+                                   int(node_config.value('fetch-idle-per-host', 4)),
+                                   int(node_config.value('fetch-parse-workers', 2)))
+        self.version = None
+        self.last_modified = None
+        self.loaded = set()
+        self.lock = threading.Lock()
+
+    def run(self) -> Future:
+        return self.pool.submit(self.sync())
+
+    async def sync(self):
+        url = self.url
+        headers = {'Accept': f'{changeset_type}, {rdfbin.binary_type}, application/n-triples;q=0.9, text/turtle;q=0.8'}
+        if self.version is not None:
+            headers['If-None-Match'] = self.version
+            since = urllib.parse.urlencode({'since': self.version.strip('"')})
+            url = self.url + ('&' if '?' in self.url else '?') + since
+        elif self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        with tempfile.TemporaryFile() as body:
+            rsp = await self.pool.request(url, headers, self.timeout, self.retries, self.backoff, body)
+            if rsp.status == 304:
+                return
+            # anything but a 2xx leaves what was loaded as it is, an empty body is not an empty graph
+            if not 200 <= rsp.status < 300:
+                raise Exception(f'{rsp.url} returned {rsp.status} {rsp.reason}')
+            await asyncio.get_running_loop().run_in_executor(self.pool.parse_pool, self.load, rsp, body)
+
+    def load(self, rsp, body):
+        """parses the spooled body into the store, runs on a parse thread"""
+        content_type = rsp.headers.get('content-type', '')
+        body.flush()
+        with self.lock:
+            if content_type.startswith(rdfbin.binary_type):
+                self.replace_with(self.read_binary(body))
+            else:
+                body.seek(0)
+                data = body.read().decode('utf-8')
+                if content_type.startswith(changeset_type):
+                    self.apply_changeset(data)
+                else:
+                    self.replace_all(data, 'nt' if content_type.startswith('application/n-triples') else 'turtle')
+            self.version, self.last_modified = rsp.headers.get('etag'), rsp.headers.get('last-modified')
+
+    @staticmethod
+    def read_binary(f):
+        """decodes a binary rdf file through a memory map"""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return set(rdfbin.read_triples(mapped))
+
+    def replace_all(self, data, rdf_format):
+        g = r.Graph()
+        g.parse(data=data, format=rdf_format)
+        self.replace_with(set(g))
+
+    def replace_with(self, triples):
+        self.update(triples - self.loaded, self.loaded - triples)
+
+    def apply_changeset(self, data):
+        added, removed = {}, {}
+        for line in data.splitlines():
+            if line.startswith('A '):
+                added[line[2:]] = True
+                removed.pop(line[2:], None)
+            elif line.startswith('D '):
+                removed[line[2:]] = True
+                added.pop(line[2:], None)
+        self.update(self.parse_lines(added), self.parse_lines(removed))
+
+    @staticmethod
+    def parse_lines(lines):
+        g = r.Graph()
+        g.parse(data='\n'.join(lines), format='nt')
+        return set(g)
+
+    def update(self, added, removed):
+        with self.node.store.transaction() as batch:
+            batch.remove_many(removed)
+            batch.add_many(added)
+        self.loaded -= removed
+        self.loaded |= added
@@ -1,6 +1,15 @@
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict
 import rdflib as r
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.plugins.sparql.sparql import Query
+from rdflib.util import from_n3
 from pybars import Compiler
 compiler = Compiler()
+parse_lock = threading.Lock()  # the sparql parser (pyparsing) is not thread safe
 
 
 class NodeConstants:
@@ -9,16 +18,21 @@ class NodeConstants:
     processor_type = r.URIRef(config_uri_stub+'Processor')
     cron_predicate = r.URIRef(config_uri_stub+'cron')
     sparql_predicate = r.URIRef(config_uri_stub + 'sparql')
+    query_type = r.URIRef(config_uri_stub + 'Query')
 
 
 
-def get_class(class_name, node, config ):
+def load_class(class_name):
     parts = class_name.split('.')
     module = ".".join(parts[:-1])
     m = __import__(module)
     for comp in parts[1:]:
         m = getattr(m, comp)
-    obj = m(config=config)
+    return m
+
+
+def get_class(class_name, node, config ):
+    obj = load_class(class_name)(config=config)
     return obj
 
 
@@ -38,11 +52,313 @@ def ensure(value, uri_stub=None):
     return value
 
 
-def run_query(store, query_uri:r.URIRef, args=None):
+class LruCache:
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.items:
+                self.hits += 1
+                self.items.move_to_end(key)
+                return self.items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+        return value
+
+    def discard(self, match):
+        with self.lock:
+            for key in [k for k in self.items if match(k)]:
+                del self.items[key]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        return {'size': len(self.items), 'max-size': self.max_size, 'hits': self.hits, 'misses': self.misses}
+
+
+class PreparedQuery:
+    """a c:sparql template compiled once, and where the template only uses its args as plain values
+    (optionally inside #if/#unless blocks) a parsed query per block shape with the args as initBindings"""
+    placeholder = re.compile(r'{{\s*([^{}#/^!>&\s]+)\s*}}')
+    block = re.compile(r'{{\s*(?:[#/](?:if|unless)(?:\s+([^{}\s]+))?|else)\s*}}')
+
+    def __init__(self, sparql: str):
+        self.sparql = sparql
+        self.template = compiler.compile(sparql)
+        self.args = self.get_bindable_args(sparql)
+        self.block_args = set(x for x in PreparedQuery.block.findall(sparql) if x)
+        self.shapes = {}
+        self.rendered = LruCache(32)
+
+    @staticmethod
+    def get_bindable_args(sparql):
+        args = set()
+        for match in PreparedQuery.placeholder.finditer(sparql):
+            if match.group(1) == 'else':
+                continue
+            before = sparql[match.start() - 1] if match.start() > 0 else ' '
+            after = sparql[match.end()] if match.end() < len(sparql) else ' '
+            if before in '"\'<:{' or after in '"\'>:}' or before.isalnum() or after.isalnum():
+                return None
+            args.add(match.group(1))
+        rest = PreparedQuery.block.sub('', PreparedQuery.placeholder.sub('', sparql))
+        if '{{' in rest:
+            return None
+        return args
+
+    @staticmethod
+    def variable_for(arg):
+        return 'arg_' + re.sub(r'\W', '_', arg)
+
+    def get_bindings(self, args):
+        bindings = {}
+        for name, value in args.items():
+            if not value or name not in self.args:
+                continue
+            term = value if isinstance(value, r.term.Identifier) else None
+            if term is None:
+                try:
+                    term = from_n3(str(value))
+                except Exception:
+                    return None
+            if term is None or isinstance(term, r.BNode):
+                return None
+            bindings[self.variable_for(name)] = term
+        return bindings
+
+    def prepare(self, args=None):
+        args = {} if args is None else args
+        if self.args is not None:
+            bindings = self.get_bindings(args)
+            if bindings is not None:
+                # an arg only used by #if/#unless changes the shape without being bound
+                shape = tuple(sorted(k for k in args if args[k] and (k in self.args or k in self.block_args)))
+                if shape not in self.shapes:
+                    context = {k: '?' + self.variable_for(k) if k in self.args else True for k in shape}
+                    self.shapes[shape] = prepare_sparql(str(self.template(context)))
+                return self.shapes[shape], bindings
+        output = str(self.template(args))
+        query = self.rendered.get(output)
+        if query is None:
+            query = self.rendered.put(output, prepare_sparql(output))
+        return query, None
+
+
+def prepare_sparql(sparql):
+    with parse_lock:
+        return prepareQuery(sparql)
+
+
+def paginate(query: Query, offset=0, limit=None) -> Query:
+    """a copy of a select query that returns rows offset to offset + limit in a stable order. the projected
+    variables are added to the order by (after the query's own order conditions) and the slice is combined with
+    the query's own limit and offset"""
+    main = query.algebra
+    if main.name != 'SelectQuery':
+        raise Exception('only select queries can be paged')
+    top = main.p
+    start, length = 0, None
+    if top.name == 'Slice':
+        start, length, top = top.start or 0, top.length, top.p
+    wrappers = []
+    while top.name in ('Distinct', 'Reduced'):
+        wrappers.append(top)
+        top = top.p
+    if top.name != 'Project':
+        raise Exception(f'can not page a query with a {top.name} on top')
+    inner, conditions = top.p, []
+    if inner.name == 'OrderBy':
+        inner, conditions = inner.p, list(inner.expr)
+    ordered = set(x.expr for x in conditions)
+    conditions += [CompValue('OrderCondition', expr=v, order=None) for v in top.PV if v not in ordered]
+    paged = CompValue('Project', p=CompValue('OrderBy', p=inner, expr=conditions), PV=top.PV)
+    for wrapper in reversed(wrappers):
+        paged = CompValue(wrapper.name, p=paged)
+    if length is not None:
+        limit = max(0, length - offset) if limit is None else max(0, min(limit, length - offset))
+    paged = CompValue('Slice', p=paged, start=start + offset, length=limit)
+    return Query(query.prologue, CompValue('SelectQuery', p=paged, datasetClause=main.datasetClause, PV=main.PV))
+
+
+# algebra parts that can take solutions away when triples are added
+non_monotonic_parts = {'LeftJoin', 'Minus', 'Group', 'AggregateJoin', 'Slice', 'Builtin_EXISTS', 'Builtin_NOTEXISTS',
+                       'SelectQuery', 'ServiceGraphPattern', 'Graph'}
+
+
+def find_names(part):
+    """the names of all the algebra parts in part"""
+    names = set()
+    if isinstance(part, CompValue):
+        names.add(part.name)
+        part = list(part.values())
+    if isinstance(part, (list, tuple)):
+        for x in part:
+            names |= find_names(x)
+    return names
+
+
+def find_bgps(part):
+    if isinstance(part, CompValue):
+        if part.name == 'BGP':
+            return [part]
+        part = list(part.values())
+    if isinstance(part, (list, tuple)):
+        return [bgp for x in part for bgp in find_bgps(x)]
+    return []
 
+
+def match_pattern(pattern, triple):
+    """the bindings that make the triple pattern match triple, None if it does not"""
+    bindings = {}
+    for p, t in zip(pattern, triple):
+        if isinstance(p, r.Variable):
+            if bindings.get(p, t) != t:
+                return None
+            bindings[p] = t
+        elif p != t:
+            return None
+    return bindings
+
+
+def fill_patterns(patterns, solution):
+    """the triples of the patterns that solution binds in full"""
+    for pattern in patterns:
+        triple = tuple(solution.get(x) if isinstance(x, r.Variable) else x for x in pattern)
+        if None not in triple:
+            yield triple
+
+
+def conjuncts(expr):
+    """the expressions of a && b && ..."""
+    if isinstance(expr, CompValue) and expr.name == 'ConditionalAndExpression':
+        return [x for part in [expr.expr] + list(expr.other or []) for x in conjuncts(part)]
+    return [expr]
+
+
+class Derivations:
+    """the results of a monotonic query (constructed triples, rows) with the sets of source triples of each
+    solution that gave them. a result is gone when all its solutions have lost a source triple, the solutions an
+    added triple takes part in are found by binding it to each triple pattern of the query"""
+    def __init__(self):
+        self.patterns = []
+        self.derivations: Dict[tuple, set] = {}  # result -> set of frozensets of source triples
+        self.used_by: Dict[tuple, set] = {}  # source triple -> results
+
+    def clear(self):
+        self.derivations.clear()
+        self.used_by.clear()
+
+    def solutions_with(self, added, evaluate):
+        """the solutions that use a triple of added, evaluate(bindings) gives the solutions for some bindings"""
+        seen = set()
+        for triple in added:
+            for pattern in self.patterns:
+                bindings = match_pattern(pattern, triple)
+                if bindings is None:
+                    continue
+                for solution in evaluate(bindings):
+                    key = frozenset(solution.items())
+                    if key not in seen:
+                        seen.add(key)
+                        yield solution
+
+    def sources(self, solution, contains):
+        return frozenset(t for t in fill_patterns(self.patterns, solution) if contains(t))
+
+    def add(self, result, sources):
+        """records that sources derive result, True when nothing derived it before"""
+        new = result not in self.derivations
+        self.derivations.setdefault(result, set()).add(sources)
+        for source in sources:
+            self.used_by.setdefault(source, set()).add(result)
+        return new
+
+    def retract(self, removed):
+        """forgets the solutions that used a triple of removed, returns the results that have none left"""
+        gone = []
+        for source in removed:
+            for result in self.used_by.pop(source, ()):
+                derivations = self.derivations.get(result)
+                if derivations is None:
+                    continue
+                derivations -= {x for x in derivations if source in x}
+                if len(derivations) == 0:
+                    del self.derivations[result]
+                    gone.append(result)
+        return gone
+
+
+class QueryCache:
+    def __init__(self, max_size=256):
+        self.cache = LruCache(max_size)
+
+    def get(self, query_uri, sparql):
+        key = (query_uri, str(sparql))
+        prepared = self.cache.get(key)
+        if prepared is None:
+            prepared = self.cache.put(key, PreparedQuery(str(sparql)))
+        return prepared
+
+    def invalidate(self, query_uri=None):
+        if query_uri is None:
+            self.cache.clear()
+        else:
+            self.cache.discard(lambda key: key[0] == query_uri)
+
+    def refresh(self, store):
+        # drop the entries whose c:sparql has changed underneath us (e.g. after a parse)
+        for query_uri, sparql in list(self.cache.items):
+            if str(store.value(query_uri, NodeConstants.sparql_predicate)) != sparql:
+                self.cache.discard(lambda key: key == (query_uri, sparql))
+
+    def stats(self):
+        stats = self.cache.stats()
+        rendered = [prepared.rendered for prepared in list(self.cache.items.values())]
+        stats['rendered-hits'] = sum(x.hits for x in rendered)
+        stats['rendered-misses'] = sum(x.misses for x in rendered)
+        return stats
+
+
+def get_sparql(store, query_uri: r.URIRef):
     sparql = store.value(query_uri, NodeConstants.sparql_predicate)
     if sparql is None:
         raise Exception(f'the query {query_uri} does not have a predicate {NodeConstants.sparql_predicate}')
-    template = compiler.compile(sparql)
-    output = template(args)
-    return store.run_sparql(output)
\ No newline at end of file
+    return sparql
+
+
+def prepare_query(store, query_uri: r.URIRef, args=None, cache: QueryCache = None, page=None):
+    """the prepared query and its init bindings for the c:sparql template of query_uri, page is an
+    (offset, limit) pair that is pushed into the query"""
+    sparql = get_sparql(store, query_uri)
+    if cache is None:
+        query, bindings = prepare_sparql(str(compiler.compile(sparql)(args))), None
+    else:
+        query, bindings = cache.get(query_uri, sparql).prepare(args)
+    if page is not None:
+        query = paginate(query, *page)
+    return query, bindings
+
+
+def run_query(store, query_uri: r.URIRef, args=None, cache: QueryCache = None, page=None):
+
+    if cache is None and page is None:
+        sparql = get_sparql(store, query_uri)
+        template = compiler.compile(sparql)
+        output = template(args)
+        return store.run_sparql(output)
+    query, bindings = prepare_query(store, query_uri, args, cache, page)
+    return store.run_sparql(query, bindings)
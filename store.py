@@ -1,12 +1,175 @@
+import heapq
+import json
+import sqlite3
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from itertools import chain
+import rdflib.store
+import metrics
+from rdflib.plugins.sparql.evaluate import evalPart
 from rdflib.plugins.sparql.processor import SPARQLResult
+from rdflib.plugins.sparql.sparql import QueryContext
+from indexes import LiteralIndexes
 from rdfops import *
 
 
+class StoreDelta:
+    """the triples added to and removed from a store since the last take()"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.added = set()
+        self.removed = set()
+
+    def record(self, added, removed):
+        with self.lock:
+            self.removed -= added
+            self.added |= added
+            self.added -= removed
+            self.removed |= removed
+
+    def take(self):
+        with self.lock:
+            added, removed = self.added, self.removed
+            self.added, self.removed = set(), set()
+            return added, removed
+
+    def empty(self):
+        return len(self.added) == 0 and len(self.removed) == 0
+
+
+query_seconds = metrics.histogram('ldnode_store_query_seconds', 'time a named query took', ('query', 'kind'))
+transaction_seconds = metrics.histogram('ldnode_store_transaction_seconds', 'time a write transaction took')
+triples_written = metrics.counter('ldnode_store_triples_written_total', 'triples added to or removed from a store',
+                                  ('change',))
+
+
+class ReadWriteLock:
+    """many readers or one writer, a waiting writer goes before new readers. the writing thread may read and
+    write again, a reading thread can not start to write (that would wait forever on itself)"""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = {}
+        self.writer = None
+        self.writes = 0
+        self.waiting_writers = 0
+
+    def is_writer(self):
+        return self.writer == threading.get_ident()
+
+    @contextmanager
+    def read(self, blocking=True):
+        """yields False without taking the lock when blocking is off and a writer is in the way"""
+        me = threading.get_ident()
+        with self.condition:
+            acquired = True
+            if self.writer != me and me not in self.readers:
+                while self.writer is not None or self.waiting_writers > 0:
+                    if not blocking:
+                        acquired = False
+                        break
+                    self.condition.wait()
+            if acquired:
+                self.readers[me] = self.readers.get(me, 0) + 1
+        if not acquired:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            with self.condition:
+                self.readers[me] -= 1
+                if self.readers[me] == 0:
+                    del self.readers[me]
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer != me:
+                if me in self.readers:
+                    raise Exception('a thread can not write to the store while it is reading from it')
+                self.waiting_writers += 1
+                while self.writer is not None or len(self.readers) > 0:
+                    self.condition.wait()
+                self.waiting_writers -= 1
+                self.writer = me
+            self.writes += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writes -= 1
+                if self.writes == 0:
+                    self.writer = None
+                    self.condition.notify_all()
+
+
+class GraphSnapshot:
+    """the graph as of a generation: a full copy (base) and the triples added and removed since the copy was made"""
+    def __init__(self, base: r.Graph, generation, added=frozenset(), removed=frozenset()):
+        self.base = base
+        self.generation = generation
+        self.added = added
+        self.removed = removed
+        self.g = base if len(added) == 0 and len(removed) == 0 else \
+            r.Graph(store=SnapshotTripleStore(base, added, removed))
+        self.taken = time.monotonic()
+
+    def changes(self):
+        return len(self.added) + len(self.removed)
+
+
+class WriteBatch:
+    """the writes of one transaction, they go to the graph straight away and are announced once on commit"""
+    def __init__(self, g: r.Graph):
+        self.g = g
+        self.added = {}
+        self.removed = {}
+
+    def add(self, triple):
+        if triple in self.g:
+            return
+        self.g.add(triple)
+        if triple in self.removed:
+            del self.removed[triple]
+        else:
+            self.added[triple] = True
+
+    def remove(self, triple):
+        for t in list(self.g.triples(triple)):
+            self.g.remove(t)
+            if t in self.added:
+                del self.added[t]
+            else:
+                self.removed[t] = True
+
+    def add_many(self, triples):
+        for t in triples:
+            self.add(t)
+
+    def remove_many(self, triples):
+        for t in triples:
+            self.remove(t)
+
+    def rollback(self):
+        for t in self.added:
+            self.g.remove(t)
+        for t in self.removed:
+            self.g.add(t)
+        self.added.clear()
+        self.removed.clear()
+
+
 class Store:
+    generation = 0  # goes up on every write so readers can tell if anything changed
+
     def parse(self, **kwargs):
         pass
 
-    def query(self, name, *args):
+    def query(self, name, args=None, page=None):
         pass
 
     def value(self, subject, predicate):
@@ -15,7 +178,7 @@ class Store:
     def filter(self, triple):
         pass
 
-    def run_sparql(self, sparql):
+    def run_sparql(self, sparql, init_bindings=None):
         pass
 
     def add_triple(self, triple):
@@ -24,31 +187,599 @@ class Store:
     def add(self, s, p, o):
         pass
 
+    def remove_triple(self, triple):
+        pass
 
-class InMemoryStore(Store):
-    def __init__(self, uri_sub):
-        self.g = r.Graph()
+    def add_many(self, triples):
+        pass
+
+    def remove_many(self, triples):
+        pass
+
+    def transaction(self) -> WriteBatch:
+        """a context manager that holds the write lock and announces all its writes as one change"""
+        pass
+
+    def on_change(self, func):
+        """calls func(added, removed) once for every committed write or batch of writes"""
+        pass
+
+    def track(self) -> StoreDelta:
+        """starts recording the writes to this store"""
+        pass
+
+    def untrack(self, delta: StoreDelta):
+        """stops recording the writes to delta"""
+        pass
+
+    def add_index(self, predicate, kind):
+        """keeps an index of the literals of predicate that simple FILTERs of queries use"""
+        pass
+
+    def solutions(self, query, init_bindings=None):
+        """the solutions of the where part of a prepared query"""
+        pass
+
+    def select(self, name, args=None, page=None):
+        """a context with the variables and the rows of a select query, no store lock is held while the rows are sent"""
+        pass
+
+    def contains(self, triple):
+        pass
+
+    def generation_read(self):
+        """the generation the last read of this thread saw"""
+        pass
+
+
+class GraphStore(Store):
+    """a store on top of an rdflib graph, the graph's own store decides where the triples live"""
+    def __init__(self, uri_sub, graph: r.Graph, isolation='lock', snapshot_interval=1.0):
+        if isolation not in ('lock', 'snapshot'):
+            raise Exception(f'unknown isolation {isolation}, use lock or snapshot')
+        self.g = graph
         self.uri_stub = uri_sub
+        self.query_cache = QueryCache()
+        self.deltas = []
+        self.change_listeners = []
+        self.views = {}  # query uri -> materialized view, see views.py
+        self.lock = ReadWriteLock()
+        self.g.literal_indexes = self.literal_indexes = LiteralIndexes(self)
+        self.batch: WriteBatch = None
+        self.isolation = isolation
+        self.snapshot_interval = snapshot_interval
+        self.snapshot: GraphSnapshot = None
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_changes = self.track() if isolation == 'snapshot' else None
+        self.reads = threading.local()
 
     def parse(self, **kwargs):
-        self.g.parse(**kwargs)
+        if len(self.deltas) == 0 and len(self.change_listeners) == 0:
+            with self.lock.write():
+                self.g.parse(**kwargs)
+                self.g.commit()
+                self.generation += 1
+        else:
+            parsed = r.Graph()
+            parsed.parse(**kwargs)
+            self.add_many(parsed)
+        self.query_cache.refresh(self)
+
+    @contextmanager
+    def transaction(self):
+        with self.lock.write():
+            if self.batch is not None:
+                yield self.batch
+                return
+            batch = self.batch = WriteBatch(self.g)
+            started = time.perf_counter()
+            try:
+                yield batch
+            except BaseException:
+                batch.rollback()
+                raise
+            finally:
+                self.batch = None
+            self.commit(batch)
+            transaction_seconds.observe(time.perf_counter() - started)
+
+    @contextmanager
+    def reading(self):
+        """the graph to read: a snapshot in snapshot isolation, else the live graph under the read lock.
+        the writing thread always reads the live graph so it sees its own writes"""
+        if self.isolation == 'snapshot' and not self.lock.is_writer():
+            snapshot = self.get_snapshot()
+            self.reads.generation = snapshot.generation
+            yield snapshot.g
+        else:
+            with self.lock.read():
+                self.reads.generation = self.generation
+                yield self.g
+
+    def get_snapshot(self):
+        """the last committed graph. while a write is going on readers keep the previous snapshot if it is at most
+        snapshot_interval seconds old instead of waiting for the write to finish. a snapshot is the last full copy
+        with the changes committed since, the graph is only copied again when those get bigger than an eighth of it"""
+        with self.snapshot_lock:
+            snapshot = self.snapshot
+            if snapshot is not None and snapshot.generation == self.generation:
+                return snapshot
+            fresh = snapshot is not None and time.monotonic() - snapshot.taken < self.snapshot_interval
+            with self.lock.read(blocking=not fresh) as acquired:
+                if not acquired:
+                    return snapshot
+                added, removed = self.snapshot_changes.take()
+                if snapshot is not None:
+                    added, removed = (snapshot.added - removed) | added, (snapshot.removed - added) | removed
+                if snapshot is None or len(added) + len(removed) > max(1000, len(snapshot.base) // 8):
+                    g = r.Graph()
+                    g.addN((s, p, o, g) for s, p, o in self.g)
+                    self.snapshot = GraphSnapshot(g, self.generation)
+                else:
+                    self.snapshot = GraphSnapshot(snapshot.base, self.generation, frozenset(added), frozenset(removed))
+            return self.snapshot
+
+    def commit(self, batch: WriteBatch):
+        if len(batch.added) == 0 and len(batch.removed) == 0:
+            return
+        self.g.commit()
+        self.generation += 1
+        added, removed = set(batch.added), set(batch.removed)
+        triples_written.inc(len(added), change='added')
+        triples_written.inc(len(removed), change='removed')
+        for delta in self.deltas:
+            delta.record(added, removed)
+        for t in chain(added, removed):
+            if t[1] == NodeConstants.sparql_predicate:
+                self.query_cache.invalidate(t[0])
+        for listener in self.change_listeners:
+            listener(added, removed)
+
+    def on_change(self, func):
+        self.change_listeners.append(func)
+
+    def add_index(self, predicate, kind):
+        """keeps a 'range' or 'text' index of the literals of predicate for the FILTERs of queries, see indexes.py"""
+        with self.lock.write():
+            index = self.literal_indexes.add(r.URIRef(str(predicate)), kind)
+            index.update(set(self.g.triples((None, index.predicate, None))), set())
+        self.on_change(index.update)
+
+    def load_indexes(self, config):
+        if config is None:
+            return
+        for predicate in config.values('range-index'):
+            self.add_index(predicate, 'range')
+        for predicate in config.values('text-index'):
+            self.add_index(predicate, 'text')
 
     def value(self, subject: r.URIRef, predicate:r.URIRef):
-        value = self.g.value(subject, predicate)
+        with self.reading() as g:
+            value = g.value(subject, predicate)
         return value
 
     def filter(self, triple):
-        return self.g.triples(triple)
+        with self.reading() as g:
+            return list(g.triples(triple))
 
-    def query(self, name, args=None) -> SPARQLResult:
-        return run_query(self, ensure(name, self.uri_stub), args)
+    def query(self, name, args=None, page=None) -> SPARQLResult:
+        uri = ensure(name, self.uri_stub)
+        view = self.views.get(uri)
+        if view is not None:
+            with query_seconds.time(query=uri, kind='view'):
+                result = view.result(args, page)
+            if result is not None:
+                return result
+        with query_seconds.time(query=uri, kind='query'):
+            return run_query(self, uri, args, self.query_cache, page)
 
-    def run_sparql(self, sparql):
-        return self.g.query(sparql)
+    def run_sparql(self, sparql, init_bindings=None):
+        if isinstance(sparql, str):
+            # readers run in parallel now and the sparql parser is not thread safe
+            sparql = prepare_sparql(sparql)
+        with self.reading() as g:
+            result = g.query(sparql, initBindings=init_bindings)
+            if result.type == 'SELECT' and g is self.g:
+                # rows are evaluated lazily, read them while we hold the lock
+                result.bindings
+        return result
 
     def add_triple(self, triple):
-        self.g.add(triple)
+        with self.transaction() as batch:
+            batch.add(triple)
 
     def add(self, s, p, o):
-        self.g.add((ensure(s, self.uri_stub), ensure(p, self.uri_stub), ensure(o)))
+        self.add_triple((ensure(s, self.uri_stub), ensure(p, self.uri_stub), ensure(o)))
+
+    def remove_triple(self, triple):
+        with self.transaction() as batch:
+            batch.remove(triple)
+
+    def add_many(self, triples):
+        with self.transaction() as batch:
+            batch.add_many(triples)
+
+    def remove_many(self, triples):
+        with self.transaction() as batch:
+            batch.remove_many(triples)
+
+    def track(self) -> StoreDelta:
+        delta = StoreDelta()
+        self.deltas.append(delta)
+        return delta
+
+    def untrack(self, delta: StoreDelta):
+        with self.lock.write():
+            self.deltas.remove(delta)
+
+    def solutions(self, query, init_bindings=None):
+        with self.reading() as g:
+            ctx = QueryContext(g, initBindings=init_bindings)
+            return list(evalPart(ctx, query.algebra.p))
+
+    @contextmanager
+    def select(self, name, args=None, page=None):
+        """in lock isolation the rows are read under the lock before the context opens, so sending them to a slow
+        client does not hold up writers. in snapshot isolation they are evaluated as they are read"""
+        uri = ensure(name, self.uri_stub)
+        view = self.views.get(uri)
+        if view is not None:
+            with query_seconds.time(query=uri, kind='view'):
+                selected = view.select(args, page)
+            if selected is not None:
+                yield selected[0], iter(selected[1])
+                return
+        query, bindings = prepare_query(self, uri, args, self.query_cache, page)
+        if query.algebra.name != 'SelectQuery':
+            raise Exception(f'{name} is not a select query')
+        # the rows are read in the context, so this is the time until the last row was read
+        with query_seconds.time(query=uri, kind='select'):
+            with self.reading() as g:
+                ctx = QueryContext(g, initBindings={r.Variable(k): v for k, v in (bindings or {}).items()})
+                ctx.prologue = query.prologue
+                # like rdflib, solutions without any bound variable are not rows
+                rows = (row for row in evalPart(ctx, query.algebra.p) if row)
+                if g is self.g:
+                    rows = list(rows)
+            yield query.algebra['PV'], iter(rows)
+
+    def contains(self, triple):
+        with self.reading() as g:
+            return triple in g
+
+    def generation_read(self):
+        return getattr(self.reads, 'generation', None)
+
+    def read_at(self, generation):
+        """for readers of the graph that do not go through reading(), like the materialized views"""
+        self.reads.generation = generation
+
+
+class InMemoryStore(GraphStore):
+    """c:isolation 'lock' makes queries wait for writes, 'snapshot' runs them on a snapshot of the graph (a copy
+    and the changes since), during a write queries use the old snapshot for up to c:snapshot-interval seconds"""
+    def __init__(self, uri_sub, config=None):
+        isolation = 'lock' if config is None else config.value('isolation', 'lock')
+        snapshot_interval = 1.0 if config is None else float(config.value('snapshot-interval', 1.0))
+        super().__init__(uri_sub, r.Graph(), isolation, snapshot_interval)
+        self.load_indexes(config)
+
+
+class SqliteStore(GraphStore):
+    """keeps the triples in a sqlite file (c:store-file) so they survive a restart and do not need to fit in ram"""
+    def __init__(self, uri_sub, config=None, file_name=None):
+        if file_name is None:
+            file_name = 'ldnode.db' if config is None else config.value('store-file', 'ldnode.db')
+        super().__init__(uri_sub, r.Graph(store=SqliteTripleStore(file_name)))
+        self.load_indexes(config)
+
+
+class TripleStore(rdflib.store.Store):
+    """the parts of an rdflib store that ldnode's stores share: one graph without contexts and a prefix map"""
+    context_aware = False
+    formula_aware = False
+    transaction_aware = False
+
+    def __init__(self):
+        super().__init__()
+        self.prefixes = {}
+
+    def contexts(self, triple=None):
+        return iter(())
+
+    def bind(self, prefix, namespace, override=True):
+        if override or prefix not in self.prefixes:
+            self.prefixes[prefix] = namespace
+
+    def namespace(self, prefix):
+        return self.prefixes.get(prefix)
+
+    def prefix(self, namespace):
+        for prefix, ns in self.prefixes.items():
+            if ns == namespace:
+                return prefix
+        return None
+
+    def namespaces(self):
+        return iter(list(self.prefixes.items()))
+
+
+class SnapshotTripleStore(TripleStore):
+    """a read only graph: a full copy of the store's graph with the triples added and removed since"""
+    def __init__(self, base: r.Graph, added, removed):
+        super().__init__()
+        self.base = base
+        self.changed = added | removed
+        self.added = r.Graph()
+        self.added.addN((s, p, o, self.added) for s, p, o in added)
+        self.size = len(base) - sum(1 for t in removed if t in base) + sum(1 for t in added if t not in base)
+
+    def triples(self, triple_pattern, context=None):
+        for triple in self.base.triples(triple_pattern):
+            if triple not in self.changed:
+                yield triple, iter(())
+        for triple in self.added.triples(triple_pattern):
+            yield triple, iter(())
+
+    def __len__(self, context=None):
+        return self.size
+
+
+class CompactStore(GraphStore):
+    """keeps the triples as integer ids in sorted arrays, a fraction of the memory of rdflib's memory store.
+    c:buffer-size sets how many writes are collected before they are merged into the arrays"""
+    def __init__(self, uri_sub, config=None):
+        buffer_size = 10000 if config is None else int(config.value('buffer-size', 10000))
+        super().__init__(uri_sub, r.Graph(store=CompactTripleStore(buffer_size)))
+        self.load_indexes(config)
+
+
+class CompactTripleStore(TripleStore):
+    """every term is interned once and gets an integer id. the triples are kept three times as flat arrays of
+    ids (s p o s p o ...) sorted in spo, pos and osp order, so any triple pattern is a binary search for a
+    prefix in one of them. writes go to a small indexed buffer that is merged into the arrays when it gets
+    bigger than buffer_size or an eighth of the store, whichever is larger"""
+    # the positions of s, p and o in each order, and the order to search for each set of bound positions
+    orders = {'spo': (0, 1, 2), 'pos': (1, 2, 0), 'osp': (2, 0, 1)}
+    order_for = {(): 'spo', (0,): 'spo', (1,): 'pos', (2,): 'osp', (0, 1): 'spo', (1, 2): 'pos', (0, 2): 'osp',
+                 (0, 1, 2): 'spo'}
+
+    def __init__(self, buffer_size=10000):
+        super().__init__()
+        self.buffer_size = buffer_size
+        self.terms = []
+        self.ids = {}
+        self.index = {name: array('q') for name in self.orders}
+        self.added = set()
+        self.added_by = ({}, {}, {})
+        self.removed = set()
+        self.lock = threading.RLock()
+
+    def term_id(self, term, create=False):
+        term_id = self.ids.get(term)
+        if term_id is None and create:
+            term_id = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+    @staticmethod
+    def bound(ids, prefix, upper):
+        """the first triple in ids whose first len(prefix) ids are >= prefix (> prefix when upper is set)"""
+        lo, hi = 0, len(ids) // 3
+        size = len(prefix)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = ids[mid * 3:mid * 3 + size].tolist()
+            if key < prefix or (upper and key == prefix):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def in_index(self, triple):
+        ids = self.index['spo']
+        start = self.bound(ids, list(triple), False)
+        return start < len(ids) // 3 and ids[start * 3:start * 3 + 3].tolist() == list(triple)
+
+    def match(self, pattern):
+        """the id triples matching a pattern of ids and Nones, from the arrays and the buffer"""
+        positions = tuple(i for i, x in enumerate(pattern) if x is not None)
+        name = self.order_for[positions]
+        order = self.orders[name]
+        ids = self.index[name]
+        prefix = [pattern[i] for i in order if pattern[i] is not None]
+        start, end = self.bound(ids, prefix, False), self.bound(ids, prefix, True)
+        removed = self.removed
+        for i in range(start * 3, end * 3, 3):
+            triple = [0, 0, 0]
+            triple[order[0]], triple[order[1]], triple[order[2]] = ids[i], ids[i + 1], ids[i + 2]
+            triple = tuple(triple)
+            if len(removed) == 0 or triple not in removed:
+                yield triple
+        if len(self.added) > 0:
+            candidates = self.added
+            for i in positions:
+                found = self.added_by[i].get(pattern[i], ())
+                if len(found) < len(candidates):
+                    candidates = found
+            for triple in list(candidates):
+                if all(triple[i] == pattern[i] for i in positions):
+                    yield triple
+
+    def add(self, triple, context, quoted=False):
+        with self.lock:
+            ids = tuple(self.term_id(x, True) for x in triple)
+            if ids in self.removed:
+                self.removed.discard(ids)
+            elif ids not in self.added and not self.in_index(ids):
+                self.added.add(ids)
+                for i, term_id in enumerate(ids):
+                    self.added_by[i].setdefault(term_id, set()).add(ids)
+                self.merge_if_full()
+        super().add(triple, context, quoted)
+
+    def remove(self, triple_pattern, context=None):
+        with self.lock:
+            pattern = [None if x is None else self.term_id(x) for x in triple_pattern]
+            if any(x is None and t is not None for x, t in zip(pattern, triple_pattern)):
+                return
+            for ids in list(self.match(pattern)):
+                if ids in self.added:
+                    self.added.discard(ids)
+                    for i, term_id in enumerate(ids):
+                        self.added_by[i][term_id].discard(ids)
+                        if len(self.added_by[i][term_id]) == 0:
+                            del self.added_by[i][term_id]
+                else:
+                    self.removed.add(ids)
+            self.merge_if_full()
+
+    def merge_if_full(self):
+        if len(self.added) + len(self.removed) > max(self.buffer_size, len(self.index['spo']) // 24):
+            self.merge()
+
+    def merge(self):
+        """write the buffer into the arrays. new arrays are built so running reads keep their old ones"""
+        with self.lock:
+            index = {}
+            for name, order in self.orders.items():
+                ids = self.index[name]
+                removed = set(tuple(t[i] for i in order) for t in self.removed)
+                kept = zip(ids[0::3], ids[1::3], ids[2::3])
+                if len(removed) > 0:
+                    kept = (x for x in kept if x not in removed)
+                added = sorted(tuple(t[i] for i in order) for t in self.added)
+                merged = array('q')
+                merged.extend(chain.from_iterable(heapq.merge(kept, added)))
+                index[name] = merged
+            self.index = index
+            self.added = set()
+            self.added_by = ({}, {}, {})
+            self.removed = set()
+
+    def triples(self, triple_pattern, context=None):
+        with self.lock:
+            pattern = [None if x is None else self.term_id(x) for x in triple_pattern]
+            if any(x is None and t is not None for x, t in zip(pattern, triple_pattern)):
+                return
+            # match reads the buffer that writes change in place, it is read in full under the lock
+            matches = list(self.match(pattern))
+        terms = self.terms
+        for s, p, o in matches:
+            yield (terms[s], terms[p], terms[o]), iter(())
+
+    def __len__(self, context=None):
+        with self.lock:
+            return len(self.index['spo']) // 3 - len(self.removed) + len(self.added)
+
+
+class SqliteTripleStore(TripleStore):
+    """an rdflib store on sqlite. terms are stored once in a term table and the triples as term ids with an
+    spo primary key and pos and osp covering indexes, so every triple pattern is answered from an index"""
+    fetch_size = 1000
+    columns = ('s', 'p', 'o')
+
+    def __init__(self, file_name):
+        super().__init__()
+        self.db = sqlite3.connect(file_name, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.ids = LruCache(100000)
+        self.terms = LruCache(100000)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT NOT NULL UNIQUE)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS triples (s INTEGER NOT NULL, p INTEGER NOT NULL, '
+                        'o INTEGER NOT NULL, PRIMARY KEY (s, p, o)) WITHOUT ROWID')
+        self.db.execute('CREATE INDEX IF NOT EXISTS pos ON triples (p, o, s)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS osp ON triples (o, s, p)')
+        self.db.commit()
+
+    @staticmethod
+    def encode(term):
+        if isinstance(term, r.Literal):
+            return 'L' + json.dumps([str(term), term.language, None if term.datatype is None else str(term.datatype)])
+        if isinstance(term, r.BNode):
+            return 'B' + str(term)
+        return 'U' + str(term)
+
+    def decode(self, text):
+        term = self.terms.get(text)
+        if term is None:
+            if text[0] == 'L':
+                value, language, datatype = json.loads(text[1:])
+                term = r.Literal(value, lang=language, datatype=datatype)
+            elif text[0] == 'B':
+                term = r.BNode(text[1:])
+            else:
+                term = r.URIRef(text[1:])
+            self.terms.put(text, term)
+        return term
+
+    def term_id(self, term, create=False):
+        text = self.encode(term)
+        term_id = self.ids.get(text)
+        if term_id is None:
+            if create:
+                self.db.execute('INSERT OR IGNORE INTO terms (term) VALUES (?)', (text,))
+            row = self.db.execute('SELECT id FROM terms WHERE term = ?', (text,)).fetchone()
+            if row is None:
+                return None
+            term_id = self.ids.put(text, row[0])
+        return term_id
+
+    def where(self, triple_pattern):
+        """the where clause and its parameters for a triple pattern, None if a bound term is not in the store"""
+        clauses, params = [], []
+        for column, term in zip(self.columns, triple_pattern):
+            if term is None:
+                continue
+            term_id = self.term_id(term)
+            if term_id is None:
+                return None
+            clauses.append(f't.{column} = ?')
+            params.append(term_id)
+        return (' WHERE ' + ' AND '.join(clauses)) if len(clauses) > 0 else '', params
+
+    def add(self, triple, context, quoted=False):
+        with self.lock:
+            ids = [self.term_id(x, True) for x in triple]
+            self.db.execute('INSERT OR IGNORE INTO triples (s, p, o) VALUES (?, ?, ?)', ids)
+        super().add(triple, context, quoted)
+
+    def remove(self, triple_pattern, context=None):
+        with self.lock:
+            where = self.where(triple_pattern)
+            if where is not None:
+                self.db.execute(f'DELETE FROM triples AS t{where[0]}', where[1])
+
+    def triples(self, triple_pattern, context=None):
+        with self.lock:
+            where = self.where(triple_pattern)
+            if where is None:
+                return
+            cursor = self.db.execute('SELECT term_s.term, term_p.term, term_o.term FROM triples AS t '
+                                     'JOIN terms AS term_s ON term_s.id = t.s '
+                                     'JOIN terms AS term_p ON term_p.id = t.p '
+                                     f'JOIN terms AS term_o ON term_o.id = t.o{where[0]}', where[1])
+        while True:
+            # the lock is not held between batches, sparql evaluation nests these calls
+            with self.lock:
+                rows = cursor.fetchmany(self.fetch_size)
+            if len(rows) == 0:
+                return
+            for s, p, o in rows:
+                yield (self.decode(s), self.decode(p), self.decode(o)), iter(())
+
+    def __len__(self, context=None):
+        with self.lock:
+            return self.db.execute('SELECT count(*) FROM triples').fetchone()[0]
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
 
+    def close(self, commit_pending_transaction=False):
+        with self.lock:
+            if commit_pending_transaction:
+                self.db.commit()
+            self.db.close()
@@ -13,9 +13,10 @@ from ldnode import *
 # todo: type templates and PyNode template
 
 
-n = LdNode(config='config.ttl', uri='https://test.people', uri_stub='https://person/')
-n.start()
-#n.stop()
+if __name__ == '__main__':
+    n = LdNode(config='config.ttl', uri='https://test.people', uri_stub='https://person/')
+    n.start()
+    #n.stop()
 
 
 
@@ -0,0 +1,29 @@
+import os
+import socket
+import sys
+import time
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope='session')
+def http_port():
+    """the port of the http server. sanic serves its app once per process, so the server is shared and a test
+    module points it at its node through web.http_session.node"""
+    import web
+    port = free_port()
+    web.start_http_server(None, 'localhost', port)
+    for _ in range(50):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    yield port
+    web.stop_http_server()
@@ -0,0 +1,73 @@
+import threading
+from ldnode import Bus
+
+
+class Blocker:
+    """a listener that holds the bus's only worker until it is released"""
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = []
+
+    def __call__(self, value):
+        self.calls.append(value)
+        self.started.set()
+        self.release.wait(5)
+
+
+def busy_bus(policy='block', queue_size=2):
+    bus = Bus(workers=1, queue_size=queue_size, policy=policy)
+    listener = Blocker()
+    bus.on('e', listener)
+    bus.emit_async('e', 'first')
+    assert listener.started.wait(5)
+    return bus, listener
+
+
+def drain(bus, listener):
+    listener.release.set()
+    bus.stop()
+    for thread in bus.threads:
+        thread.join(5)
+
+
+def test_same_call_is_coalesced():
+    bus, listener = busy_bus(queue_size=10)
+    for _ in range(5):
+        bus.emit_async('e', 'again')
+    assert bus.stats()['queues']['e']['coalesced'] == 4
+    drain(bus, listener)
+    assert listener.calls == ['first', 'again']
+
+
+def test_drop_newest_keeps_the_queued_calls():
+    bus, listener = busy_bus('drop-newest')
+    for i in range(4):
+        bus.emit_async('e', i)
+    assert bus.stats()['queues']['e']['dropped'] == 2
+    drain(bus, listener)
+    assert listener.calls == ['first', 0, 1]
+
+
+def test_drop_oldest_keeps_the_latest_calls():
+    bus, listener = busy_bus('drop-oldest')
+    for i in range(4):
+        bus.emit_async('e', i)
+    assert bus.stats()['queues']['e']['dropped'] == 2
+    drain(bus, listener)
+    assert listener.calls == ['first', 2, 3]
+
+
+def test_block_holds_the_emitter_until_there_is_room():
+    bus, listener = busy_bus('block')
+    bus.emit_async('e', 0)
+    bus.emit_async('e', 1)
+    emitter = threading.Thread(target=bus.emit_async, args=('e', 2))
+    emitter.start()
+    emitter.join(0.3)
+    assert emitter.is_alive()
+    listener.release.set()
+    emitter.join(5)
+    assert not emitter.is_alive()
+    drain(bus, listener)
+    assert listener.calls == ['first', 0, 1, 2]
@@ -0,0 +1,110 @@
+import pytest
+import rdflib as r
+import web
+from ldnode import LdNode
+
+C = 'http://node/config/'
+publisher_config = '''@prefix c: <http://node/config/> .
+<https://test.publisher> c:http_port {port} .
+c:people a c:Processor ;
+    c:class-name "pubsub.Publisher" ;
+    c:file '{csv}' ;
+    c:subject-template '{{{{id}}}}' ;
+    c:uri-stub 'https://person/' ;
+    c:cache true ;
+    c:cache-dir '{cache}' ;
+    c:watch false .
+'''
+consumer_config = '''@prefix c: <http://node/config/> .
+<https://test.consumer> c:http_port 0 .
+c:load a c:Processor ;
+    c:class-name "pubsub.Consumer" ;
+    c:target 'http://localhost:{port}/publisher/people' ;
+    c:retries 0 ;
+    c:timeout 5 .
+'''
+
+
+@pytest.fixture(scope='module')
+def publisher(tmp_path_factory, http_port):
+    folder = tmp_path_factory.mktemp('changesets')
+    csv = folder / 'people.csv'
+    csv.write_text('id,age\n0,0\n')
+    config_file = folder / 'publisher.ttl'
+    config_file.write_text(publisher_config.format(port=http_port, csv=csv, cache=folder / 'cache'))
+    node = LdNode(config=str(config_file), uri='https://test.publisher', uri_stub='https://person/')
+    publisher = node.processors[r.URIRef(C + 'people')]
+    publisher.run()
+    web.http_session.node = node
+    publisher.port, publisher.csv, publisher.rows = http_port, csv, 1
+    return publisher
+
+
+@pytest.fixture
+def consumer(publisher, tmp_path):
+    config_file = tmp_path / 'consumer.ttl'
+    config_file.write_text(consumer_config.format(port=publisher.port))
+    node = LdNode(config=str(config_file), uri='https://test.consumer', uri_stub='https://person/')
+    consumer = node.processors[r.URIRef(C + 'load')]
+    consumer.changesets = []
+    apply_changeset = consumer.apply_changeset
+
+    def record(data):
+        consumer.changesets.append(data)
+        apply_changeset(data)
+    consumer.apply_changeset = record
+    consumer.run().result()
+    return consumer
+
+
+def change(publisher, rows=1):
+    """adds rows and changes the first one, then rebuilds the output"""
+    for _ in range(rows):
+        publisher.rows += 1
+        lines = [f'{i},{i + publisher.rows}' for i in range(publisher.rows)]
+        publisher.csv.write_text('id,age\n' + '\n'.join(lines) + '\n')
+        publisher.run()
+
+
+def published(publisher):
+    g = r.Graph()
+    g.parse(publisher.output.file_name, format='nt')
+    return set(g)
+
+
+def loaded(consumer):
+    return {t for t in consumer.node.store.filter((None, None, None)) if t[0].startswith('https://person/')}
+
+
+def test_a_consumer_applies_the_changeset_of_a_rebuild(publisher, consumer):
+    assert loaded(consumer) == published(publisher) and consumer.changesets == []
+    change(publisher)
+    consumer.run().result()
+    assert len(consumer.changesets) == 1
+    assert loaded(consumer) == published(publisher)
+    assert consumer.version == publisher.output_cache.etag
+
+
+def test_a_consumer_applies_the_chain_of_changesets_since_its_version(publisher, consumer):
+    change(publisher, 3)
+    consumer.run().result()
+    assert len(consumer.changesets) == 1
+    assert consumer.changesets[0].count('H id ') == 3
+    assert loaded(consumer) == published(publisher)
+
+
+def test_a_consumer_behind_the_history_downloads_everything(publisher, consumer):
+    version = consumer.version.strip('"')
+    change(publisher, publisher.output_cache.history + 1)
+    assert publisher.output_cache.changesets_since(version) is None
+    consumer.run().result()
+    assert consumer.changesets == []
+    assert loaded(consumer) == published(publisher)
+
+
+def test_a_replayed_changeset_changes_nothing(publisher, consumer):
+    change(publisher)
+    consumer.run().result()
+    expected = loaded(consumer)
+    consumer.apply_changeset(consumer.changesets[-1])
+    assert loaded(consumer) == expected == published(publisher)
@@ -0,0 +1,35 @@
+import threading
+import rdflib as r
+from store import CompactStore
+
+P = 'https://person/'
+age = r.URIRef(P + 'age')
+
+
+def person(i):
+    return r.URIRef(P + str(i)), age, r.Literal(i % 7)
+
+
+def test_compact_store_reads_while_it_is_written():
+    store = CompactStore(P)
+    store.g.store.buffer_size = 50
+    store.add_many([person(i) for i in range(500)])
+    failures = []
+
+    def write():
+        for i in range(500, 2000):
+            store.g.store.add(person(i), None)
+
+    def read():
+        try:
+            for _ in range(200):
+                list(store.g.store.triples((None, age, None)))
+        except Exception as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=write), threading.Thread(target=read)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert failures == []
@@ -0,0 +1,50 @@
+import rdflib as r
+from ldnode import Config, LdNode
+
+C = 'http://node/config/'
+built = []
+
+
+class Counting:
+    def __init__(self, config=None):
+        built.append(config.uri)
+
+    def run(self, *args, **kwargs):
+        pass
+
+    def check(self, *args, **kwargs):
+        pass
+
+
+config_data = '''
+@prefix c: <http://node/config/> .
+<https://node> c:store-class "store.InMemoryStore" .
+c:first a c:Processor ; c:class-name "test_config.Counting" ; c:on c:a, c:b ; c:raise c:c .
+c:second a c:Processor ; c:class-name "test_config.Counting" ; c:on c:c ; c:default-method "check" .
+'''
+
+
+def test_each_processor_is_built_once(tmp_path):
+    path = tmp_path / 'config.ttl'
+    path.write_text(config_data)
+    built.clear()
+    node = LdNode(config=str(path), uri='https://node')
+    first, second = r.URIRef(C + 'first'), r.URIRef(C + 'second')
+    assert sorted(built) == [first, second]
+    # every event of a processor calls the processor in node.processors
+    assert node.pipeline.calls[first].__self__ is node.processors[first]
+    assert node.pipeline.calls[second].__self__ is node.processors[second]
+    assert node.config.subject(first).obj() is node.processors[first]
+    assert len(built) == 2
+
+
+def test_config_snapshot_follows_the_generation():
+    config = Config(data=config_data)
+    subject = config.subject('first')
+    snapshot = config.snapshot()
+    assert config.snapshot() is snapshot
+    assert subject.value('default-method', 'run') == 'run'
+    config.store.add_triple((subject.uri, r.URIRef(C + 'default-method'), r.Literal('check')))
+    assert config.snapshot() is not snapshot
+    assert config.snapshot().generation == config.store.generation
+    assert subject.value('default-method', 'run') == 'check'
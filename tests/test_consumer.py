@@ -0,0 +1,114 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import rdflib as r
+import fetch
+from ldnode import LdNode
+
+data = b'<https://person/1> <https://person/age> "1" .\n<https://person/2> <https://person/age> "2" .\n'
+etag = '"v1"'
+config = '''@prefix c: <http://node/config/> .
+<https://test.consumer> c:http_port 0 .
+c:load a c:Processor ;
+    c:class-name "pubsub.Consumer" ;
+    c:target '{target}' ;
+    c:retries 0 ;
+    c:timeout 5 .
+'''
+
+
+class Publisher(BaseHTTPRequestHandler):
+    """serves data on /data, what the other paths do is set in Publisher.routes"""
+    protocol_version = 'HTTP/1.1'
+    routes = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        status, location = Publisher.routes.get(path, (200, None))
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status = 304
+        self.send_response(status)
+        if location is not None:
+            self.send_header('Location', location)
+        if status == 200:
+            self.send_header('ETag', etag)
+            self.send_header('Content-Type', 'application/n-triples')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = ThreadingHTTPServer(('localhost', 0), Publisher)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://localhost:{server.server_port}'
+    server.shutdown()
+
+
+def consumer_of(tmp_path, url):
+    config_file = tmp_path / 'config.ttl'
+    config_file.write_text(config.format(target=url))
+    node = LdNode(config=str(config_file), uri='https://test.consumer', uri_stub='https://person/')
+    return node, node.processors[r.URIRef('http://node/config/load')]
+
+
+def ages(node):
+    return set(node.store.filter((None, r.URIRef('https://person/age'), None)))
+
+
+def test_redirect_is_followed(server, tmp_path):
+    Publisher.routes = {'/moved': (301, '/data')}
+    node, consumer = consumer_of(tmp_path, server + '/moved')
+    consumer.run().result()
+    assert len(ages(node)) == 2
+
+
+def test_not_modified_keeps_the_data(server, tmp_path):
+    Publisher.routes = {}
+    node, consumer = consumer_of(tmp_path, server + '/data')
+    consumer.run().result()
+    assert consumer.version == etag
+    consumer.run().result()
+    assert len(ages(node)) == 2
+
+
+@pytest.mark.parametrize('status, location', [(302, None), (300, None), (307, '/loop'), (500, None)])
+def test_other_statuses_keep_the_data(server, tmp_path, status, location):
+    Publisher.routes = {}
+    node, consumer = consumer_of(tmp_path, server + '/loop')
+    consumer.run().result()
+    consumer.version = None
+    Publisher.routes = {'/loop': (status, location)}
+    with pytest.raises(Exception):
+        consumer.run().result()
+    assert len(ages(node)) == 2
+
+
+class Sent:
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+
+@pytest.mark.parametrize('version, connection, reusable', [
+    ('HTTP/1.1', None, True), ('HTTP/1.1', 'close', False), ('HTTP/1.1', 'Keep-Alive', True),
+    ('HTTP/1.0', None, False), ('HTTP/1.0', 'close', False), ('HTTP/1.0', 'keep-alive', True)])
+def test_a_connection_is_kept_when_the_http_version_allows_it(version, connection, reusable):
+    async def exchange():
+        reader = asyncio.StreamReader()
+        headers = 'Content-Length: 2\r\n' + ('' if connection is None else f'Connection: {connection}\r\n')
+        reader.feed_data(f'{version} 200 OK\r\n{headers}\r\nok'.encode())
+        reader.feed_eof()
+        return await fetch.HttpPool.exchange(reader, Sent(), 'localhost', '/', {}, None, 5)
+    response, kept = asyncio.run(exchange())
+    assert response.body == b'ok' and kept == reusable
@@ -0,0 +1,73 @@
+import random
+import rdflib as r
+from processors import IncrementalConstruct
+from rdfops import NodeConstants
+from store import InMemoryStore
+
+P = 'https://person/'
+query_uri = r.URIRef(P + 'construct')
+constructs = {
+    'fullname': '''CONSTRUCT { ?s <https://person/fullname> ?fullname }
+        WHERE { ?s <https://person/first> ?first ; <https://person/last> ?last .
+                BIND(CONCAT(?first, " ", ?last) AS ?fullname) }''',
+    'join': '''CONSTRUCT { ?s <https://person/in-law> ?o }
+        WHERE { ?s <https://person/spouse> ?x . ?x <https://person/sibling> ?o FILTER(?s != ?o) }''',
+}
+sources = ('first', 'last', 'spouse', 'sibling')
+targets = (r.URIRef(P + 'fullname'), r.URIRef(P + 'in-law'))
+
+
+def random_triple(rnd):
+    predicate = rnd.choice(sources)
+    o = r.Literal(rnd.choice('abc')) if predicate in ('first', 'last') else r.URIRef(P + str(rnd.randrange(8)))
+    return r.URIRef(P + str(rnd.randrange(8))), r.URIRef(P + predicate), o
+
+
+def constructed(store):
+    return set(t for t in store.g if t[1] in targets)
+
+
+def full_construct(store, sparql):
+    return set(store.g.query(sparql))
+
+
+def check(name, steps=40, seed=1):
+    rnd = random.Random(seed)
+    store = InMemoryStore(P)
+    store.add_triple((query_uri, NodeConstants.sparql_predicate, r.Literal(constructs[name])))
+    store.add_many([random_triple(rnd) for _ in range(30)])
+    incremental = IncrementalConstruct(store, query_uri)
+    assert incremental.run()
+    for _ in range(steps):
+        triples = [random_triple(rnd) for _ in range(rnd.randint(1, 5))]
+        if rnd.random() < 0.6:
+            store.add_many(triples)
+        else:
+            store.remove_many([t for t in store.g if t[1] != NodeConstants.sparql_predicate and
+                               rnd.random() < 0.1 and t[1] not in targets])
+        assert incremental.run()
+        assert constructed(store) == full_construct(store, constructs[name])
+
+
+def test_incremental_fullname_matches_full_construct():
+    check('fullname')
+
+
+def test_incremental_join_matches_full_construct():
+    check('join', seed=2)
+
+
+def test_changed_query_retracts_what_it_constructed():
+    store = InMemoryStore(P)
+    store.add_triple((query_uri, NodeConstants.sparql_predicate, r.Literal(constructs['fullname'])))
+    store.add_many([(r.URIRef(P + '1'), r.URIRef(P + 'first'), r.Literal('a')),
+                    (r.URIRef(P + '1'), r.URIRef(P + 'last'), r.Literal('b'))])
+    incremental = IncrementalConstruct(store, query_uri)
+    incremental.run()
+    assert len(constructed(store)) == 1
+    deltas = len(store.deltas)
+    store.remove_triple((query_uri, NodeConstants.sparql_predicate, None))
+    store.add_triple((query_uri, NodeConstants.sparql_predicate, r.Literal(constructs['join'])))
+    incremental.run()
+    assert constructed(store) == set()
+    assert len(store.deltas) == deltas
@@ -0,0 +1,57 @@
+import random
+from datetime import date
+from decimal import Decimal
+import rdflib as r
+from indexes import index_scans, prefix_of
+from store import InMemoryStore
+
+P = 'https://person/'
+ages = [r.Literal(1), r.Literal(30), r.Literal(45), r.Literal(Decimal('30.5')), r.Literal(29.9), r.Literal('30'),
+        r.Literal(date(1990, 1, 2)), r.Literal(True), r.URIRef(P + 'age')]
+names = ['ab', 'abc', 'Abby', 'xyz', 'xabz', 'b|c', 'ABCD', 'zab', 'a.b', '']
+filters = ['?age >= 30', '?age < 30 && ?age > 1', '?age = 45', '30 <= ?age', '?age > "1990-01-01"^^xsd:date',
+           'STRSTARTS(?name, "ab")', 'STRSTARTS(?name, "")', 'CONTAINS(?name, "abc")', 'CONTAINS(LCASE(?name), "abb")',
+           'REGEX(?name, "^ab")', 'REGEX(?name, "^ab.*|xyz")', 'REGEX(?name, "^ab|^xa")', 'REGEX(?name, "^a(b|x)")',
+           'REGEX(?name, "^abc?")', 'REGEX(?name, "^b\\\\|c")', 'REGEX(?name, "^ab", "i")']
+
+
+def people(rnd):
+    triples = []
+    for i in range(80):
+        s = r.URIRef(P + str(i))
+        triples.append((s, r.URIRef(P + 'age'), rnd.choice(ages)))
+        name = rnd.choice(names)
+        triples.append((s, r.URIRef(P + 'name'), r.Literal(name, lang='en') if rnd.random() < 0.1 else r.Literal(name)))
+    return triples
+
+
+def test_prefix_of_a_regex():
+    assert prefix_of('^ab.*') == 'ab'
+    assert prefix_of('^abc?') == 'ab'
+    assert prefix_of('^a(b|c)') == 'a'
+    assert prefix_of('^ab[|]') == 'ab'
+    assert prefix_of('^ab.*|xyz') == ''
+    assert prefix_of('^ab|^xa') == ''
+    assert prefix_of('ab') == ''
+
+
+def test_indexed_filters_return_the_rows_of_a_scan():
+    rnd = random.Random(5)
+    triples = people(rnd)
+    indexed, plain = InMemoryStore(P), InMemoryStore(P)
+    indexed.add_many(triples[:100])
+    indexed.add_index(P + 'age', 'range')
+    indexed.add_index(P + 'name', 'text')
+    indexed.add_many(triples[100:])
+    plain.add_many(triples)
+    # writes after the indexes are built reach them too
+    for store in (indexed, plain):
+        store.remove_triple(triples[0])
+        store.add_triple((triples[0][0], triples[0][1], r.Literal(60)))
+    scans = sum(index_scans.values.values())
+    for f in filters:
+        sparql = f'''PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+        SELECT ?s ?age ?name WHERE {{ ?s <{P}age> ?age ; <{P}name> ?name . FILTER({f}) }}'''
+        expected = sorted(tuple(x) for x in plain.run_sparql(sparql))
+        assert sorted(tuple(x) for x in indexed.run_sparql(sparql)) == expected, f
+    assert sum(index_scans.values.values()) > scans
@@ -0,0 +1,20 @@
+import gc
+import metrics
+from ldnode import LdNode, metered_nodes
+
+config = '''@prefix c: <http://node/config/> .
+<https://test.metrics> c:store-class "store.InMemoryStore" .
+'''
+
+
+def test_nodes_do_not_add_collectors(tmp_path):
+    config_file = tmp_path / 'config.ttl'
+    config_file.write_text(config)
+    collectors = len(metrics.registry.collectors)
+    nodes = [LdNode(config=str(config_file), uri='https://test.metrics') for _ in range(3)]
+    assert len(metrics.registry.collectors) == collectors
+    assert all(x in metered_nodes for x in nodes)
+    assert 'ldnode_store_generation{node="https://test.metrics"}' in metrics.registry.render()
+    del nodes
+    gc.collect()
+    assert not any(str(x.uri) == 'https://test.metrics' for x in metered_nodes)
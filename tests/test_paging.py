@@ -0,0 +1,71 @@
+import json
+import urllib.error
+import urllib.parse
+import urllib.request
+import pytest
+import rdflib as r
+import web
+from ldnode import LdNode
+
+config = '''@prefix c: <http://node/config/> .
+<https://test.paging> c:http_port {port} .
+<https://person/ages> a c:Query ;
+    c:sparql \'\'\'SELECT ?s ?age WHERE {{ ?s <https://person/age> ?age }} ORDER BY ?age\'\'\' .
+'''
+
+
+@pytest.fixture(scope='module')
+def node(tmp_path_factory, http_port):
+    config_file = tmp_path_factory.mktemp('paging') / 'config.ttl'
+    config_file.write_text(config.format(port=http_port))
+    node = LdNode(config=str(config_file), uri='https://test.paging', uri_stub='https://person/')
+    for age in range(10):
+        node.store.add(f'https://person/{age}', 'https://person/age', age)
+    web.http_session.node = node
+    node.port = http_port
+    return node
+
+
+def get(node, **args):
+    url = f'http://localhost:{node.port}/query/ages?{urllib.parse.urlencode(args)}'
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, response.headers, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, ''
+
+
+def ages(content_type, body):
+    if content_type == 'csv':
+        return [int(line.split(',')[1]) for line in body.split('\r')[1:] if line.strip()]
+    return [int(row['row']['cells'][1]['cell']) for row in json.loads(body)['rows']]
+
+
+@pytest.mark.parametrize('content_type', ['csv', 'json'])
+def test_cursor_continues_the_pages(node, content_type):
+    status, headers, body = get(node, **{'content-type': content_type, 'page-size': 4})
+    assert status == 200 and ages(content_type, body) == [0, 1, 2, 3]
+    status, headers, body = get(node, **{'content-type': content_type, 'page-size': 4,
+                                         'cursor': headers['X-Next-Cursor']})
+    assert status == 200 and ages(content_type, body) == [4, 5, 6, 7]
+
+
+@pytest.mark.parametrize('content_type', ['csv', 'json'])
+def test_cursor_is_stale_after_a_write(node, content_type):
+    _, headers, _ = get(node, **{'content-type': content_type, 'page-size': 3})
+    node.store.add('https://person/young', 'https://person/age', -1)
+    try:
+        status, _, _ = get(node, **{'content-type': content_type, 'page-size': 3, 'cursor': headers['X-Next-Cursor']})
+        assert status == 410
+    finally:
+        node.store.remove_triple((r.URIRef('https://person/young'), None, None))
+
+
+@pytest.mark.parametrize('args', [{'page-size': 'ten'}, {'cursor': 'not a cursor'}, {'cursor': '!!'}])
+def test_bad_paging_args_are_a_bad_request(node, args):
+    assert get(node, **args)[0] == 400
+
+
+def test_cursor_of_another_page_size_is_a_bad_request(node):
+    _, headers, _ = get(node, **{'content-type': 'csv', 'page-size': 3})
+    assert get(node, **{'content-type': 'csv', 'page-size': 5, 'cursor': headers['X-Next-Cursor']})[0] == 400
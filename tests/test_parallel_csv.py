@@ -0,0 +1,37 @@
+import random
+import rdflib as r
+from pubsub import CsvParser, Mapper, ParallelCsvParser, Target
+
+P = 'https://person/'
+texts = ['plain', 'two\nlines', 'a, comma', 'a || quote', '\n', '', 'ends with\r\n', 'ümlaut\nß']
+
+
+class Collect(Target):
+    def __init__(self):
+        self.triples = set()
+
+    def store(self, triples):
+        self.triples.update(triples)
+
+
+def quoted(text):
+    return '|' + text.replace('|', '||') + '|' if any(c in text for c in '|,\r\n') else text
+
+
+def parse(parser_class, file_path, **kwargs):
+    target = Collect()
+    parser_class(Mapper('{{id}}', P, P + 'Person', auto_guess_type=True), target, **kwargs).parse_file(str(file_path))
+    return target.triples
+
+
+def test_parallel_parse_maps_the_rows_of_a_serial_parse(tmp_path):
+    rnd = random.Random(6)
+    lines = ['id,note,age']
+    for i in range(300):
+        note = rnd.choice(texts).replace('||', '|')
+        lines.append(f'{i},{quoted(note)},{rnd.randrange(100)}')
+    file_path = tmp_path / 'people.csv'
+    file_path.write_bytes(('\r\n'.join(lines) + '\r\n').encode('utf-8'))
+    serial = parse(CsvParser, file_path)
+    assert len({s for s, _, _ in serial}) == 300
+    assert parse(ParallelCsvParser, file_path, workers=4, chunk_size=500) == serial
@@ -0,0 +1,85 @@
+import concurrent.futures
+import threading
+import pytest
+from ldnode import LdNode
+
+E = 'http://pipeline/'
+
+
+def recorder(calls, name, result=None, error=None):
+    def call(*args):
+        calls.append((name, threading.current_thread().name))
+        if error is not None:
+            raise Exception(error)
+        return result
+    return call
+
+
+def diamond(node, calls, fail=()):
+    """a -> b, c -> d, with d c:on the events of both b and c"""
+    for name, on, raises in (('a', 'start', ['x']), ('b', 'x', ['y']), ('c', 'x', ['z']), ('d', 'y', ['done']),
+                             ('d', 'z', ['done'])):
+        node.pipeline.add(E + on, E + name, recorder(calls, name, error='failed' if name in fail else None),
+                          [E + x for x in raises])
+
+
+def test_a_processor_runs_once_per_wave():
+    node, calls = LdNode(), []
+    diamond(node, calls)
+    node.emit(E + 'start')
+    assert sorted(x[0] for x in calls) == ['a', 'b', 'c', 'd']
+    assert calls[-1][0] == 'd'
+    node.emit(E + 'start')
+    assert [x[0] for x in calls].count('d') == 2
+
+
+def test_a_processor_runs_once_per_wave_on_the_pipeline_threads():
+    node, calls = LdNode(), []
+    diamond(node, calls)
+    node.running_async = True
+    done = threading.Event()
+    node.pipeline.add(E + 'done', E + 'e', lambda: done.set(), [])
+    node.emit(E + 'start')
+    assert done.wait(5)
+    node.pipeline.executor.shutdown(wait=True)
+    node.stop_sync_loop()
+    assert sorted(x[0] for x in calls) == ['a', 'b', 'c', 'd']
+
+
+def test_a_cycle_is_rejected():
+    node, calls = LdNode(), []
+    node.pipeline.add(E + 'start', E + 'a', recorder(calls, 'a'), [E + 'x'])
+    node.pipeline.add(E + 'x', E + 'b', recorder(calls, 'b'), [E + 'y'])
+    with pytest.raises(Exception, match='cycle'):
+        node.pipeline.add(E + 'y', E + 'a', recorder(calls, 'a'), [E + 'x'])
+    # the rejected edge is not kept
+    node.emit(E + 'start')
+    assert [x[0] for x in calls] == ['a', 'b']
+
+
+def test_downstream_processors_are_skipped_when_all_their_inputs_failed():
+    node, calls = LdNode(), []
+    diamond(node, calls, fail=('b', 'c'))
+    node.emit(E + 'start')
+    assert sorted(x[0] for x in calls) == ['a', 'b', 'c']
+    calls.clear()
+    node.pipeline.calls[E + 'c'] = recorder(calls, 'c')
+    node.emit(E + 'start')
+    assert sorted(x[0] for x in calls) == ['a', 'b', 'c', 'd']
+
+
+def test_a_wave_goes_on_on_the_pipeline_threads_when_a_future_finishes():
+    node, calls = LdNode(), []
+    future = concurrent.futures.Future()
+    done = threading.Event()
+    node.pipeline.add(E + 'start', E + 'a', recorder(calls, 'a', result=future), [E + 'x'])
+    node.pipeline.add(E + 'x', E + 'b', recorder(calls, 'b'), [E + 'y'])
+    node.pipeline.add(E + 'y', E + 'c', lambda: done.set(), [])
+    node.emit(E + 'start')
+    assert [x[0] for x in calls] == ['a']
+    finisher = threading.Thread(target=future.set_result, args=(None,), name='finisher')
+    finisher.start()
+    finisher.join()
+    assert done.wait(5)
+    assert calls[1][0] == 'b' and calls[1][1].startswith('pipeline')
+    node.pipeline.executor.shutdown(wait=True)
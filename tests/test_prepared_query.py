@@ -0,0 +1,50 @@
+import rdflib as r
+from rdfops import NodeConstants, PreparedQuery, QueryCache, run_query
+from store import InMemoryStore
+
+P = 'https://person/'
+template = '''SELECT ?s WHERE { ?s <https://person/age> ?age .
+    {{#if adults}} FILTER(?age >= 18) {{/if}}
+    {{#if min-age}} FILTER(?age >= {{min-age}}) {{/if}} }'''
+
+
+def people_store():
+    store = InMemoryStore(P)
+    store.add_many([(r.URIRef(P + str(age)), r.URIRef(P + 'age'), r.Literal(age)) for age in (5, 17, 18, 40)])
+    store.add_triple((r.URIRef(P + 'people'), NodeConstants.sparql_predicate, r.Literal(template)))
+    return store
+
+
+def ages(store, args):
+    rows = run_query(store, r.URIRef(P + 'people'), args, store.query_cache)
+    return sorted(int(str(row[0])[len(P):]) for row in rows)
+
+
+def test_block_args_are_part_of_the_shape():
+    query = PreparedQuery(template)
+    assert query.args == {'min-age'}
+    assert query.block_args == {'adults', 'min-age'}
+    plain, _ = query.prepare({})
+    adults, bindings = query.prepare({'adults': 'yes'})
+    assert plain is not adults
+    assert bindings == {}
+
+
+def test_filter_in_an_if_block_is_applied():
+    store = people_store()
+    assert ages(store, {}) == [5, 17, 18, 40]
+    assert ages(store, {'adults': 'yes'}) == [18, 40]
+    assert ages(store, {'min-age': '30'}) == [40]
+    assert ages(store, {'adults': 'yes', 'min-age': '10'}) == [18, 40]
+
+
+def test_prepared_and_rendered_queries_agree():
+    store = people_store()
+    for args in ({}, {'adults': 'yes'}, {'min-age': '17'}, {'adults': '', 'min-age': '18'}):
+        rendered = run_query(store, r.URIRef(P + 'people'), args)
+        assert ages(store, args) == sorted(int(str(row[0])[len(P):]) for row in rendered)
+
+
+def test_query_cache_keeps_one_prepared_query_per_template():
+    cache = QueryCache()
+    assert cache.get('q', template) is cache.get('q', template)
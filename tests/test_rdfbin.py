@@ -0,0 +1,25 @@
+import pytest
+import rdflib as r
+import rdfbin
+
+triples = [(r.URIRef(f'https://person/{i}'), r.URIRef('https://person/age'), r.Literal(i)) for i in range(100)] + \
+          [(r.BNode('b'), r.URIRef('https://person/name'), r.Literal('é', lang='fr'))]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_round_trip(tmp_path, compress):
+    file_name = str(tmp_path / 'data.rdfb')
+    rdfbin.write_file(file_name, triples, compress)
+    assert list(rdfbin.read_file(file_name)) == triples
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_decode_errors_are_not_hidden_by_the_mmap(tmp_path, compress):
+    file_name = str(tmp_path / 'data.rdfb')
+    rdfbin.write_file(file_name, triples, compress)
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    with open(file_name, 'wb') as f:
+        f.write(data[:-20])
+    with pytest.raises(Exception, match='cut short'):
+        list(rdfbin.read_file(file_name))
@@ -0,0 +1,45 @@
+import os
+import time
+from datetime import datetime
+import pytest
+import rdflib as r
+from ldnode import LdNode
+
+C = 'http://node/config/'
+config_data = '''
+@prefix c: <http://node/config/> .
+<https://node> c:store-class "store.InMemoryStore" .
+c:scheduler a c:Processor ; c:class-name "processors.Scheduler" .
+'''
+
+
+@pytest.fixture(params=['America/New_York', 'Asia/Kolkata', 'UTC'])
+def zone(request):
+    old = os.environ.get('TZ')
+    os.environ['TZ'] = request.param
+    time.tzset()
+    yield request.param
+    if old is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = old
+    time.tzset()
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    path = tmp_path / 'config.ttl'
+    path.write_text(config_data)
+    node = LdNode(config=str(path), uri='https://node')
+    return node.processors[r.URIRef(C + 'scheduler')]
+
+
+def test_next_run_is_the_next_local_cron_time(zone, scheduler):
+    now = time.time()
+    for cron, period in (('*/5 * * * *', 300), ('0 * * * *', 3600)):
+        next_run = scheduler.next_run(cron, now)
+        # a start read as utc puts the deadline hours off, in the past west of utc
+        assert now < next_run <= now + period
+        local = datetime.fromtimestamp(next_run)
+        assert local.second == 0 and local.minute % (period // 60 if period < 3600 else 60) == 0
+
@@ -0,0 +1,25 @@
+import threading
+import rdflib as r
+from rdfops import NodeConstants
+from store import InMemoryStore
+
+P = 'https://person/'
+age = r.URIRef(P + 'age')
+
+
+def person(i):
+    return r.URIRef(P + str(i)), age, r.Literal(i % 7)
+
+
+def test_select_does_not_hold_the_store_lock_while_rows_are_read():
+    store = InMemoryStore(P)
+    store.add_many([person(i) for i in range(10)])
+    store.add_triple((r.URIRef(P + 'ages'), NodeConstants.sparql_predicate,
+                      r.Literal('SELECT ?s ?age WHERE { ?s <https://person/age> ?age }')))
+    with store.select('ages') as (variables, rows):
+        next(rows)
+        writer = threading.Thread(target=store.add_triple, args=(person(99),))
+        writer.start()
+        writer.join(5)
+        assert not writer.is_alive()
+        assert len(list(rows)) == 9
@@ -0,0 +1,27 @@
+import random
+import rdflib as r
+from store import InMemoryStore
+
+P = 'https://person/'
+age = r.URIRef(P + 'age')
+
+
+def person(i):
+    return r.URIRef(P + str(i)), age, r.Literal(i % 7)
+
+
+def test_snapshots_follow_the_writes():
+    store = InMemoryStore(P)
+    store.isolation, store.snapshot_changes = 'snapshot', store.track()
+    store.add_many([person(i) for i in range(2000)])
+    rnd = random.Random(1)
+    for _ in range(100):
+        triples = [person(rnd.randrange(3000)) for _ in range(20)]
+        if rnd.random() < 0.5:
+            store.add_many(triples)
+        else:
+            store.remove_many(triples)
+        snapshot = store.get_snapshot()
+        assert set(snapshot.g) == set(store.g)
+        assert len(snapshot.g) == len(store.g)
+        assert set(snapshot.g.triples((None, age, r.Literal(3)))) == set(store.g.triples((None, age, r.Literal(3))))
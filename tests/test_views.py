@@ -0,0 +1,42 @@
+import random
+import rdflib as r
+from rdfops import NodeConstants
+from store import InMemoryStore
+from views import MaterializedView
+
+P = 'https://person/'
+queries = ['SELECT ?s ?v WHERE { ?s <https://person/v> ?v }',
+           'SELECT DISTINCT ?v WHERE { ?s <https://person/v> ?v }',
+           'SELECT ?s ?v WHERE { ?s <https://person/v> ?v } ORDER BY DESC(?v)']
+values = [r.Literal(1), r.Literal('1'), r.Literal(2.5), r.Literal('abc'), r.URIRef('https://z'),
+          r.Literal('b', lang='en')]
+
+
+def test_pages_of_a_view_are_the_pages_of_the_query():
+    rnd = random.Random(3)
+    uri = r.URIRef(P + 'q')
+    for sparql in queries:
+        triples = [(r.URIRef(P + str(rnd.randrange(20))), r.URIRef(P + 'v'), rnd.choice(values)) for _ in range(60)]
+        viewed, plain = InMemoryStore(P), InMemoryStore(P)
+        for store in (viewed, plain):
+            store.add_many(triples)
+            store.add_triple((uri, NodeConstants.sparql_predicate, r.Literal(sparql)))
+        viewed.views[uri] = MaterializedView(viewed, uri)
+        for page in ((0, 7), (7, 7), (14, 100)):
+            assert [tuple(x) for x in viewed.query('q', page=page)] == [tuple(x) for x in plain.query('q', page=page)]
+
+
+def test_view_follows_the_writes():
+    uri = r.URIRef(P + 'q')
+    store = InMemoryStore(P)
+    store.add_triple((uri, NodeConstants.sparql_predicate, r.Literal(queries[0])))
+    store.views[uri] = MaterializedView(store, uri)
+    rnd = random.Random(4)
+    for _ in range(30):
+        triple = (r.URIRef(P + str(rnd.randrange(5))), r.URIRef(P + 'v'), rnd.choice(values))
+        if rnd.random() < 0.6:
+            store.add_triple(triple)
+        else:
+            store.remove_triple(triple)
+        rows = set(tuple(x) for x in store.query('q'))
+        assert rows == set(tuple(x) for x in store.run_sparql(queries[0]))
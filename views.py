@@ -0,0 +1,242 @@
+import threading
+from itertools import chain
+import rdflib as r
+from rdflib.plugins.sparql.evaluate import evalPart
+from rdflib.plugins.sparql.evalutils import _ebv, _val
+from rdflib.plugins.sparql.sparql import FrozenBindings, QueryContext
+from rdflib.query import Result
+import metrics
+from rdfops import *
+from store import StoreDelta
+
+view_updates = metrics.counter('ldnode_view_updates_total', 'materialized view updates', ('query', 'kind'))
+view_reads = metrics.counter('ldnode_view_reads_total', 'reads of materialized views, by what answered them',
+                             ('query', 'answer'))
+
+
+class MaterializedView:
+    """the rows of a c:Query with c:materialize true, kept in memory and answered without running the query.
+    writes that use none of the query's predicates are ignored. monotonic queries are kept up to date the way
+    IncrementalConstruct does it: every row keeps the sets of triples it was derived from, removed triples retract
+    the rows that used them and added triples are bound to each triple pattern to find the new rows. other queries
+    are evaluated again. c:refresh 'eager' catches up on a thread of its own after every write, 'lazy' when the view
+    is read. args are applied to the rows as the filters they add to the query, when the template does more with
+    them than that the query is run as usual"""
+    policies = ('eager', 'lazy')
+
+    def __init__(self, store, uri, policy='lazy'):
+        if policy not in MaterializedView.policies:
+            raise Exception(f'unknown refresh policy {policy}, use one of {MaterializedView.policies}')
+        self.store = store
+        self.uri = uri
+        self.policy = policy
+        self.changes = StoreDelta()
+        self.lock = threading.Lock()
+        self.sparql = None
+        self.query = None
+        self.shape = None
+        self.where = None  # the part under the projection when the view is kept incrementally
+        self.predicates = None  # None when any write can change the rows
+        self.derivations = Derivations()  # of the rows
+        self.table = None  # the rows in order, made again after a change
+        self.built = False
+        self.generation = None  # the store generation the rows are up to date with
+        self.filters = {}  # prepared query of some args -> the filters those args add, None if they do more
+        self.wake_up = threading.Event()
+        store.on_change(self.on_change)
+        if policy == 'eager':
+            self.wake_up.set()
+            threading.Thread(target=self.keep_up, name=f'view {uri}', daemon=True).start()
+
+    def on_change(self, added, removed):
+        """called by the store as it commits (so never while the view refreshes), only records what changed"""
+        if any(t[0] == self.uri and t[1] == NodeConstants.sparql_predicate for t in chain(added, removed)):
+            self.built = False
+        if self.built and self.predicates is not None:
+            added = {t for t in added if t[1] in self.predicates}
+            removed = {t for t in removed if t[1] in self.predicates}
+            if len(added) == 0 and len(removed) == 0:
+                return
+            if self.where is not None:
+                self.changes.record(added, removed)
+            else:
+                self.built = False
+        else:
+            self.built = False
+        if self.policy == 'eager':
+            self.wake_up.set()
+
+    def keep_up(self):
+        while True:
+            self.wake_up.wait()
+            self.wake_up.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f'refreshing the view {self.uri} failed: {e}')
+
+    def refresh(self):
+        """brings the rows up to date, the store is kept from writing meanwhile"""
+        with self.store.lock.read(), self.lock:
+            generation = self.store.generation
+            if self.built and self.changes.empty():
+                self.generation = generation
+                return
+            added, removed = self.changes.take()
+            sparql = self.store.g.value(self.uri, NodeConstants.sparql_predicate)
+            if sparql is None:
+                raise Exception(f'the query {self.uri} does not have a predicate {NodeConstants.sparql_predicate}')
+            if str(sparql) != self.sparql or not self.built:
+                self.prepare(str(sparql))
+            if not self.built or self.where is None:
+                self.rebuild()
+            elif len(added) > 0 or len(removed) > 0:
+                self.retract(removed)
+                self.apply(self.solutions_with(added))
+                self.table = None
+                view_updates.inc(query=self.uri, kind='incremental')
+            self.generation = generation
+
+    def prepare(self, sparql):
+        self.sparql = sparql
+        self.filters.clear()
+        query, _ = self.store.query_cache.get(self.uri, sparql).prepare({})
+        if query.algebra.name != 'SelectQuery':
+            raise Exception(f'{self.uri} is not a select query, only those can be materialized')
+        self.query = query
+        self.shape = self.split(query)
+        self.derivations.patterns = [t for bgp in find_bgps(query.algebra.p) for t in bgp.triples]
+        predicates = [t[1] for t in self.derivations.patterns]
+        self.predicates = set(predicates) if all(isinstance(x, r.URIRef) for x in predicates) else None
+        where = None if self.shape is None else self.shape[2]
+        if where is None or find_names(where) & non_monotonic_parts or self.shape[1] or self.predicates is None:
+            where = None
+        self.where = where
+
+    @staticmethod
+    def split(query):
+        """(distinct, ordered, the part under the projection, its filters) of a select without a slice"""
+        top = query.algebra.p
+        distinct = False
+        while top.name in ('Distinct', 'Reduced'):
+            distinct = distinct or top.name == 'Distinct'
+            top = top.p
+        if top.name != 'Project':
+            return None
+        where, ordered = top.p, False
+        if where.name == 'OrderBy':
+            where, ordered = where.p, True
+        filters = []
+        if where.name == 'Filter':
+            filters = conjuncts(where.expr)
+        return distinct, ordered, where, filters
+
+    def evaluate(self, part, bindings=None):
+        ctx = QueryContext(self.store.g, initBindings={} if bindings is None else bindings)
+        ctx.prologue = self.query.prologue
+        return list(evalPart(ctx, part))
+
+    def rebuild(self):
+        self.derivations.clear()
+        if self.where is None:
+            # in the order the query has when it is paged, so a page of the view is the page of the query
+            query = paginate(self.query) if self.shape is not None else self.query
+            self.table = [row for row in (self.row(x) for x in self.evaluate(query.algebra.p)) if row]
+        else:
+            self.apply(self.evaluate(self.where))
+            self.table = None
+        self.built = True
+        view_updates.inc(query=self.uri, kind='full')
+
+    def row(self, solution):
+        row = tuple(solution.get(v) for v in self.query.algebra.PV)
+        return row if any(x is not None for x in row) else None
+
+    def solutions_with(self, added):
+        return self.derivations.solutions_with(added, lambda bindings: self.evaluate(self.where, bindings))
+
+    def apply(self, solutions):
+        for solution in solutions:
+            row = self.row(solution)
+            if row is not None:
+                self.derivations.add(row, self.derivations.sources(solution, lambda t: t in self.store.g))
+
+    def retract(self, removed):
+        self.derivations.retract(removed)
+
+    def rows(self):
+        if self.table is None:
+            distinct = self.shape[0]
+            rows = list(self.derivations.derivations)
+            # the order paginate gives the query (these have no order by of their own): by each projected
+            # variable in turn, the way rdflib sorts an ORDER BY
+            for i, variable in reversed(list(enumerate(self.query.algebra.PV))):
+                rows.sort(key=lambda row: _val(variable if row[i] is None else row[i]))
+            self.table = rows if distinct else [row for row in rows for _ in self.derivations.derivations[row]]
+        return self.table
+
+    def filters_for(self, args):
+        """the filters args add to the query, None when they change it in another way"""
+        query, bindings = self.store.query_cache.get(self.uri, self.sparql).prepare(args)
+        if query is self.query:
+            return []
+        if bindings is None:
+            return None
+        if query not in self.filters:
+            filters = None
+            shape = self.split(query)
+            if shape is not None and self.shape is not None and shape[:2] == self.shape[:2] \
+                    and query.algebra.PV == self.query.algebra.PV:
+                where = shape[2].p if shape[2].name == 'Filter' else shape[2]
+                base = self.shape[2].p if self.shape[2].name == 'Filter' else self.shape[2]
+                added = [x for x in shape[3] if x not in self.shape[3]]
+                known = set(query.algebra.PV) | {r.Variable(x) for x in bindings}
+                if where == base and all(variables_of(x) <= known for x in added) \
+                        and all(x in shape[3] for x in self.shape[3]):
+                    filters = added
+            self.filters[query] = filters
+        filters = self.filters[query]
+        return None if filters is None else [(x, bindings) for x in filters]
+
+    def select(self, args=None, page=None):
+        """the variables and rows for args and page, None when the query has to be run instead"""
+        args = {} if args is None else args
+        self.refresh()
+        with self.lock:
+            filters = self.filters_for(args)
+            if filters is None:
+                view_reads.inc(query=self.uri, answer='query')
+                return None
+            variables = list(self.query.algebra.PV)
+            rows = self.rows()
+            self.store.read_at(self.generation)
+        view_reads.inc(query=self.uri, answer='view')
+        if len(filters) > 0:
+            ctx = QueryContext(initBindings={})
+            ctx.prologue = self.query.prologue
+            bindings = {r.Variable(k): v for k, v in filters[0][1].items()}
+            rows = [row for row in rows if all(_ebv(expr, FrozenBindings(ctx, dict(
+                chain(((v, x) for v, x in zip(variables, row) if x is not None), bindings.items()))))
+                for expr, _ in filters)]
+        if page is not None:
+            rows = rows[page[0]:] if page[1] is None else rows[page[0]:page[0] + page[1]]
+        return variables, [{v: x for v, x in zip(variables, row) if x is not None} for row in rows]
+
+    def result(self, args=None, page=None) -> Result:
+        selected = self.select(args, page)
+        if selected is None:
+            return None
+        result = Result('SELECT')
+        result.vars, result.bindings = selected
+        return result
+
+
+def variables_of(expr):
+    if isinstance(expr, r.Variable):
+        return {expr}
+    if isinstance(expr, CompValue):
+        expr = [v for k, v in expr.items() if k != '_vars']
+    if isinstance(expr, (list, tuple)):
+        return set(v for x in expr for v in variables_of(x))
+    return set()
+
@@ -1,17 +1,36 @@
 import asyncio
+import base64
+import hashlib
+import json as json_lib
 import threading
+import time
+import urllib.parse
+import uuid
 from asyncio import AbstractEventLoop
 from asyncio import Future
-from rdflib.plugins.sparql.processor import SPARQLResult
+from itertools import islice
 from sanic import Sanic
+from sanic.exceptions import InvalidUsage, SanicException
 from sanic.response import *
 from sanic import response
 from pybars import Compiler
+import metrics
+from rdfops import LruCache
+import rdflib as r
 
 # from rdfnode import LdNode
 
 http = Sanic("rdf_node")
 compiler = Compiler()
+result_cache = LruCache(128)
+boot_id = uuid.uuid4().hex  # generations restart with the process so etags must not outlive it
+cacheable_size = 1 << 20  # streamed results up to this many characters also go into the result cache
+default_page_size = 100
+max_page_size = 10000
+
+
+request_seconds = metrics.histogram('ldnode_http_request_seconds',
+                                    'time until the response headers were sent, by route', ('route', 'status'))
 
 
 class http_session:
@@ -43,23 +62,150 @@ def stop_http_server():
     print('http server stopped')
 
 
-def build_result_template(result: SPARQLResult):
-    headers = [{'header': str(h)} for h in result.vars]
-    rows = []
-    i = 0
-    for row in result:
-        i = i + 1
-        cells = [{'cell': row[h].value} for h in result.vars]
-        row = {'row': {
-            'line': i,
-            'cells': cells
-        }}
-        rows.append(row)
-    context = {
-        'headers': headers,
-        'rows': rows
-    }
-    return context
+def cell_value(term):
+    if term is None:
+        return ''
+    if isinstance(term, r.Literal) and term.value is not None:
+        return term.value
+    return str(term)
+
+
+class ChunkStream:
+    """hands text chunks from a worker thread to a streaming http response, the bounded queue holds the worker
+    back when the client reads slower than we produce"""
+    def __init__(self, loop, content_type, max_chunks=16, headers=None):
+        self.loop = loop
+        self.content_type = content_type
+        self.headers = headers
+        self.queue = asyncio.Queue(max_chunks)
+        self.cancelled = False
+
+    def put(self, chunk):
+        if self.cancelled:
+            raise Exception('the client went away, stopping the stream')
+        asyncio.run_coroutine_threadsafe(self.queue.put(chunk), self.loop).result()
+
+    def close(self):
+        if not self.cancelled:
+            self.put(None)
+
+    async def send(self, request):
+        """sends the chunks until close, nothing is sent when the worker closes without a chunk (e.g. it failed)"""
+        try:
+            chunk = await self.queue.get()
+            if chunk is None:
+                return
+            stream = await request.respond(content_type=self.content_type, headers=self.headers)
+            while chunk is not None:
+                await stream.send(chunk)
+                chunk = await self.queue.get()
+            await stream.eof()
+        except BaseException:
+            self.cancelled = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            raise
+
+
+async def stream_from_thread(request, stream: ChunkStream, produce):
+    """runs produce(stream) on a worker thread and sends what it puts, produce's errors are raised here"""
+    def run():
+        try:
+            return produce(stream)
+        finally:
+            stream.close()
+
+    produced = asyncio.get_running_loop().run_in_executor(None, run)
+    try:
+        await stream.send(request)
+    finally:
+        await asyncio.wait([produced])
+    return produced.result()
+
+
+class ResultWriter:
+    """turns select rows into text one row at a time: head, a row per solution, then tail"""
+    content_type = 'text/plain; charset=utf-8'
+
+    def head(self, variables):
+        return ''
+
+    def row(self, line, variables, row):
+        pass
+
+    def tail(self):
+        return ''
+
+
+class TemplateWriter(ResultWriter):
+    def __init__(self, content_type, head, row, tail):
+        self.content_type = content_type
+        self.head_template = compiler.compile(head)
+        self.row_template = compiler.compile(row)
+        self.tail_template = compiler.compile(tail)
+
+    def head(self, variables):
+        return str(self.head_template({'headers': [{'header': str(v)} for v in variables]}))
+
+    def row(self, line, variables, row):
+        return str(self.row_template({'line': line, 'cells': [{'cell': cell_value(row.get(v))} for v in variables]}))
+
+    def tail(self):
+        return str(self.tail_template({}))
+
+
+def json_value(term):
+    value = cell_value(term)
+    return value if isinstance(value, (str, int, float, bool)) else str(term)
+
+
+class TableJsonWriter(ResultWriter):
+    """{"headers": [...], "rows": [{"row": {"line": .., "cells": [...]}}]} written a row at a time"""
+    content_type = 'application/json; charset=utf-8'
+
+    def head(self, variables):
+        return '{"headers": ' + json_lib.dumps([{'header': str(v)} for v in variables]) + ', "rows": ['
+
+    def row(self, line, variables, row):
+        cells = [{'cell': json_value(row.get(v))} for v in variables]
+        return (',' if line > 1 else '') + json_lib.dumps({'row': {'line': line, 'cells': cells}})
+
+    def tail(self):
+        return ']}'
+
+
+class JsonLinesWriter(ResultWriter):
+    content_type = 'application/x-ndjson; charset=utf-8'
+
+    def row(self, line, variables, row):
+        return json_lib.dumps({str(v): json_value(row.get(v)) for v in variables}) + '\n'
+
+
+class SparqlJsonWriter(ResultWriter):
+    content_type = 'application/sparql-results+json; charset=utf-8'
+
+    def head(self, variables):
+        return '{"head": {"vars": ' + json_lib.dumps([str(v) for v in variables]) + '}, "results": {"bindings": ['
+
+    def row(self, line, variables, row):
+        binding = {}
+        for v in variables:
+            term = row.get(v)
+            if term is None:
+                continue
+            if isinstance(term, r.Literal):
+                value = {'type': 'literal', 'value': str(term)}
+                if term.language is not None:
+                    value['xml:lang'] = term.language
+                elif term.datatype is not None:
+                    value['datatype'] = str(term.datatype)
+            else:
+                value = {'type': 'bnode' if isinstance(term, r.BNode) else 'uri', 'value': str(term)}
+            binding[str(v)] = value
+        return (',' if line > 1 else '') + json_lib.dumps(binding)
+
+    def tail(self):
+        return ']}}'
 
 
 def get_content_type(request):
@@ -71,6 +217,27 @@ def get_content_type(request):
     return content_type
 
 
+@http.middleware('request')
+async def start_timer(request):
+    request.ctx.started = time.perf_counter()
+
+
+@http.middleware('response')
+async def observe_request(request, rsp):
+    if not hasattr(request.ctx, 'started'):
+        return
+    route = request.uri_template if request.route is not None else 'unrouted'
+    took = time.perf_counter() - request.ctx.started
+    status = getattr(rsp, 'status', 0)
+    request_seconds.observe(took, route=route, status=status)
+    metrics.trace('http', route=route, path=request.path, status=status, took=took)
+
+
+@http.route('/metrics')
+async def web_metrics(request):
+    return text(metrics.registry.render(), content_type=metrics.content_type)
+
+
 @http.route("/")
 async def web_home(request):
     content_type = get_content_type(request)
@@ -87,43 +254,166 @@ async def web_data(request, publisher):
     for k in http_session.node.processors.keys():
         if str(k).endswith(publisher):
             publisher = processors[k]
-            return await publisher.get_data(response)
+            return await publisher.get_data(response, request)
+
+
+
+def get_etag(key):
+    return '"' + hashlib.sha1(repr((boot_id,) + key).encode()).hexdigest() + '"'
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is None:
+        return False
+    tags = [x.strip() for x in if_none_match.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
 
+def get_page(query, args):
+    """takes page-size and cursor out of the args, returns the (offset, size) of the page, the scope its cursors
+    are valid for and the store generation the cursor was made at (None on a first page), or None, None, None when
+    the client did not ask for a page. a bad page size or cursor is a 400"""
+    page_size, cursor = args.pop('page-size', None), args.pop('cursor', None)
+    if page_size is None and cursor is None:
+        return None, None, None
+    try:
+        page_size = max(1, min(int(page_size or default_page_size), max_page_size))
+    except ValueError:
+        raise InvalidUsage(f'page-size {page_size} is not a number')
+    scope = hashlib.sha1(repr((query, tuple(sorted(args.items())), page_size)).encode()).hexdigest()[:12]
+    offset, generation = 0, None
+    if cursor is not None:
+        try:
+            offset, cursor_scope, generation = base64.urlsafe_b64decode(cursor.encode()).decode().split('.')
+            offset, generation = int(offset), int(generation)
+        except ValueError:
+            raise InvalidUsage(f'{cursor} is not a cursor')
+        if offset < 0:
+            raise InvalidUsage(f'{cursor} is not a cursor')
+        if cursor_scope != scope:
+            raise InvalidUsage('the cursor belongs to another query, its arguments or page size changed')
+    return (offset, page_size), scope, generation
+
+
+def check_cursor(store, generation):
+    """an offset only continues a page in the data it was made on, after a write the client has to start again"""
+    if generation is not None and store.generation_read() != generation:
+        raise SanicException('the data changed since the cursor was made, start again without it', status_code=410)
+
+
+def next_page_headers(request, args, page, scope, generation):
+    """the cursor of the page after page, and a link to it"""
+    offset, page_size = page
+    cursor = base64.urlsafe_b64encode(f'{offset + page_size}.{scope}.{generation}'.encode()).decode()
+    query = dict(args, **{'page-size': page_size, 'cursor': cursor})
+    if 'content-type' in request.args:
+        query['content-type'] = request.args['content-type'][0]
+    return {'X-Next-Cursor': cursor, 'Link': f'<{request.path}?{urllib.parse.urlencode(query)}>; rel="next"'}
 
 
 @http.route('/query/<query>')
 async def web_query(request, query):
-    # todo: make json a template
     # todo: move templates to RDF
     args = {}
     for arg in request.args:
         args[arg] = request.args[arg][0]
-    rows = http_session.node.store.query(query, args)
-    ct = get_content_type(request)
-    data = build_result_template(rows)
-    if ct == 'json':
-        # todo: move json to template
-        return json(data)
-    else:
-        html_template = await get_template(ct)
-        template = compiler.compile(html_template)
-        output = template(data)
-        if ct == 'html':
-            return html(output)
-        else:
-            return text(output)
-
-async def get_template(content_type):
+    ct = content_type_aliases.get(get_content_type(request), get_content_type(request))
+    store = http_session.node.store
+    key = (query, tuple(sorted(args.items())), ct, store.generation)
+    etag = get_etag(key)
+    if etag_matches(request, etag):
+        return empty(status=304, headers={'ETag': etag})
+    args.pop('content-type', None)
+    page, scope, cursor_generation = get_page(query, args)
+    if cursor_generation is not None and cursor_generation != store.generation:
+        raise SanicException('the data changed since the cursor was made, start again without it', status_code=410)
+    headers = {'ETag': etag}
+    cached = result_cache.get(key)
+    if cached is None:
+        return await stream_result(request, store, query, args, get_writer(ct), key, headers, page, scope,
+                                   cursor_generation)
+    content_type, body, extra = cached
+    headers.update(extra)
+    return raw(body, content_type=content_type, headers=headers)
+
+
+async def stream_result(request, store, query, args, writer: ResultWriter, key, headers, page=None, scope=None,
+                        cursor_generation=None):
+    """writes the rows as the query produces them, small results are kept in the result cache as well. a page is
+    read before anything is sent so the response headers can say if there is a next one"""
+    def produce(stream: ChunkStream):
+        kept, size, extra = [], 0, {}
+        with store.select(query, args, None if page is None else (page[0], page[1] + 1)) as (variables, rows):
+            read_key = key[:-1] + (store.generation_read(),)
+            stream.headers['ETag'] = get_etag(read_key)
+            if page is not None:
+                check_cursor(store, cursor_generation)
+                rows = list(islice(rows, page[1] + 1))
+                if len(rows) > page[1]:
+                    rows = rows[:page[1]]
+                    extra = next_page_headers(request, args, page, scope, read_key[-1])
+                    stream.headers.update(extra)
+            chunk = [writer.head(variables)]
+            for line, row in enumerate(rows, 1):
+                chunk.append(writer.row(line, variables, row))
+                if len(chunk) >= 1000:
+                    size = send_chunk(stream, chunk, kept, size)
+                    chunk = []
+        chunk.append(writer.tail())
+        size = send_chunk(stream, chunk, kept, size)
+        if size <= cacheable_size:
+            result_cache.put(read_key, (writer.content_type, ''.join(kept), extra))
+
+    await stream_from_thread(request, ChunkStream(asyncio.get_running_loop(), writer.content_type, headers=headers),
+                             produce)
+
+
+def send_chunk(stream, chunk, kept, size):
+    text = ''.join(chunk)
+    size += len(text)
+    if size <= cacheable_size:
+        kept.append(text)
+    stream.put(text)
+    return size
+
+
+content_type_aliases = {
+    'text/csv': 'csv',
+    'text/html': 'html',
+    'application/x-ndjson': 'jsonl',
+    'application/json': 'json',
+    'application/sparql-results+json': 'sparql-json',
+}
+result_templates = {
+    'csv': ('text/csv; charset=utf-8',
+            '{{#each headers}}{{header}},{{/each}}\r',
+            '{{#each cells}}{{cell}},{{/each}}\r',
+            ''),
+    'html': ('text/html; charset=utf-8',
+             '<table>'
+             '<style>table \n th {background-color: #dddddd;border: 1px solid black;} \n td {border: 1px solid black;} \n tr:nth-child(even) {background-color: #f2f2f2;} </style> '
+             '<tr>'
+             '{{#each headers}} <th>{{header}}</th>{{/each}}'
+             '</tr>',
+             ' <tr> {{#each cells}}<td>{{cell}}</td>{{/each}}</tr>',
+             '</table>'),
+}
+result_writers = {
+    'json': TableJsonWriter(),
+    'jsonl': JsonLinesWriter(),
+    'sparql-json': SparqlJsonWriter(),
+}
+writers_lock = threading.Lock()
+
+
+def get_writer(content_type) -> ResultWriter:
+    """the writer for a content type, templates are compiled the first time they are asked for"""
     # todo: make templates a publisher
-    if content_type == 'csv':
-        return '{{#each headers}}{{header}},{{/each}}\r' \
-                '{{#each rows}}{{#each row.cells}}{{cell}},{{/each}}\r{{/each}}'
-    if content_type == 'html':
-        return '<table>' \
-                    '<style>table \n th {background-color: #dddddd;border: 1px solid black;} \n td {border: 1px solid black;} \n tr:nth-child(even) {background-color: #f2f2f2;} </style> ' \
-                    '<tr>' \
-                    '{{#each headers}} <th>{{header}}</th>{{/each}}' \
-                    '</tr>' \
-                    '{{#each rows}} <tr> {{#each row.cells}}<td>{{cell}}</td>{{/each}}</tr>{{/each}}' \
-                    '</table>'
-    raise Exception(f'there is no template for {content_type}')
+    with writers_lock:
+        writer = result_writers.get(content_type)
+        if writer is None:
+            if content_type not in result_templates:
+                raise Exception(f'there is no template for {content_type}')
+            writer = result_writers[content_type] = TemplateWriter(*result_templates[content_type])
+        return writer